@@ -1,12 +1,59 @@
 /*
-    Separate convolution with global memory access
+    Separate convolution with global memory access,
+    and variants (suffixed _local) which cache a tile of the image in local memory.
     The borders are handled directly in the kernel (by symetrization),
     so the input image does not need to be pre-processed
 
+    All kernels also process stacks of images: the third dimension of the
+    global size is the index of the frame in the stack (1 for a single image).
+    Frame z starts at z*IMAGE_W*IMAGE_H in input, output and previous,
+    at line z*IMAGE_H of the temporary buffer and at z*(IMAGE_W/2)*(IMAGE_H/2)
+    in shrunk. DoG "dog" of frame z starts at (dog*nframes + z)*IMAGE_W*IMAGE_H.
 */
 
 #define MAX_CONST_SIZE 16384
 
+/*
+    The temporary image between the horizontal and the vertical pass can be
+    stored in half precision (compile with -D HALF_TMP) to save bandwidth.
+    vload_half/vstore_half do not require cl_khr_fp16 and the accumulation
+    remains in single precision.
+
+    It can also be stored in an image2d_t (compile with -D IMAGE_TMP) so that
+    the vertical pass, which reads neighbours along the slow dimension, goes
+    through the texture cache. The mirrored boundaries are still calculated
+    in the kernel: the sampler only guards against out-of-bounds reads.
+    The precision is then set by the format of the image (FLOAT or HALF_FLOAT).
+*/
+/*
+    The size of the filter can be fixed at compile time (-D KSIZE=...) so that the
+    compiler knows the bounds of the loops and can unroll them. The hlen argument
+    is then ignored.
+*/
+#ifdef KSIZE
+    #define FILTER_SIZE KSIZE
+#else
+    #define FILTER_SIZE hlen
+#endif
+
+#ifdef IMAGE_TMP
+    #define TMP_OUT __write_only image2d_t
+    #define TMP_IN __read_only image2d_t
+    #define LOAD_TMP(x, y, width, img) read_imagef(img, tmp_sampler, (int2)(x, y)).x
+    #define STORE_TMP(value, x, y, width, img) write_imagef(img, (int2)(x, y), (float4)(value, 0.0f, 0.0f, 0.0f))
+    __constant sampler_t tmp_sampler = CLK_NORMALIZED_COORDS_FALSE | CLK_ADDRESS_CLAMP_TO_EDGE | CLK_FILTER_NEAREST;
+#elif defined(HALF_TMP)
+    #define TMP_OUT __global half *
+    #define TMP_IN const __global half *
+    #define LOAD_TMP(x, y, width, ptr) vload_half((y)*(width) + (x), ptr)
+    #define STORE_TMP(value, x, y, width, ptr) vstore_half(value, (y)*(width) + (x), ptr)
+#else
+    #define TMP_OUT __global float *
+    #define TMP_IN const __global float *
+    #define LOAD_TMP(x, y, width, ptr) ptr[(y)*(width) + (x)]
+    #define STORE_TMP(value, x, y, width, ptr) ptr[(y)*(width) + (x)] = value
+#endif
+
 
 
 ///
@@ -15,8 +62,8 @@
 
 __kernel void horizontal_convolution(
     const __global float * input,  // input array
-    __global float * output, // output array
-    __global float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    TMP_OUT output, // output array (temporary buffer)
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
     int hlen,       // filter size
     int IMAGE_W,
     int IMAGE_H
@@ -24,17 +71,20 @@ __kernel void horizontal_convolution(
 {
     int gidy = (int) get_global_id(1);
     int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    input += frame * IMAGE_W * IMAGE_H;
 
     if (gidy < IMAGE_H && gidx < IMAGE_W) {
 
         int c, hL, hR;
-        if (hlen & 1) { // odd kernel size
-            c = hlen/2;
+        if (FILTER_SIZE & 1) { // odd kernel size
+            c = FILTER_SIZE/2;
             hL = c;
             hR = c;
         }
         else { // even kernel size : center is shifted to the left
-            c = hlen/2 - 1;
+            c = FILTER_SIZE/2 - 1;
             hL = c;
             hR = c+1;
         }
@@ -48,9 +98,9 @@ __kernel void horizontal_convolution(
             if (jx < jx1) idx_x = jx1-jx-1;
             if (jx > jx2) idx_x = IMAGE_W - (jx-jx2);
 
-            sum += input[gidy*IMAGE_W + idx_x] * filter[hlen-1 - jx];
+            sum += input[gidy*IMAGE_W + idx_x] * filter[FILTER_SIZE-1 - jx];
         }
-        output[gidy*IMAGE_W + gidx] =  sum;
+        STORE_TMP(sum, gidx, gidy + tmp_row, IMAGE_W, output);
     }
 }
 
@@ -60,27 +110,86 @@ __kernel void horizontal_convolution(
 ///
 
 __kernel void vertical_convolution(
-    const __global float * input,  // input array
+    TMP_IN input,  // input array (temporary buffer)
+    __global float * output, // output array
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    int hlen,       // filter size
+    int IMAGE_W,
+    int IMAGE_H
+)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    output += frame * IMAGE_W * IMAGE_H;
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W) {
+
+        int c, hL, hR;
+        if (FILTER_SIZE & 1) { // odd kernel size
+            c = FILTER_SIZE/2;
+            hL = c;
+            hR = c;
+        }
+        else { // even kernel size : center is shifted to the left
+            c = FILTER_SIZE/2 - 1;
+            hL = c;
+            hR = c+1;
+        }
+        int jy1 = c - gidy;
+        int jy2 = IMAGE_H - 1 - gidy + c;
+        float sum = 0.0f;
+
+        // Convolution with boundaries extension
+        for (int jy = 0; jy <= hR+hL; jy++) {
+            int idx_y = gidy - c + jy;
+            if (jy < jy1) idx_y = jy1-jy-1;
+            if (jy > jy2) idx_y = IMAGE_H - (jy-jy2);
+
+            sum += LOAD_TMP(gidx, idx_y + tmp_row, IMAGE_W, input) * filter[FILTER_SIZE-1 - jy];
+        }
+        output[gidy*IMAGE_W + gidx] =  sum;
+    }
+}
+
+
+///
+/// Vertical convolution fused with the Difference of Gaussians
+///
+/// Same as vertical_convolution, but also stores previous - output
+/// in the DoG of index "dog", saving one full pass over the image.
+///
+
+__kernel void vertical_convolution_and_subtract(
+    TMP_IN input,  // input array (result of the horizontal pass)
+    const __global float * previous, // previous blurred image
     __global float * output, // output array
-    __global float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    __global float * dogs, // vector of all DoGs
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
     int hlen,       // filter size
+    int dog,        // index of the DoG to write
     int IMAGE_W,
     int IMAGE_H
 )
 {
     int gidy = (int) get_global_id(1);
     int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    output += frame * IMAGE_W * IMAGE_H;
+    previous += frame * IMAGE_W * IMAGE_H;
 
     if (gidy < IMAGE_H && gidx < IMAGE_W) {
 
         int c, hL, hR;
-        if (hlen & 1) { // odd kernel size
-            c = hlen/2;
+        if (FILTER_SIZE & 1) { // odd kernel size
+            c = FILTER_SIZE/2;
             hL = c;
             hR = c;
         }
         else { // even kernel size : center is shifted to the left
-            c = hlen/2 - 1;
+            c = FILTER_SIZE/2 - 1;
             hL = c;
             hR = c+1;
         }
@@ -94,13 +203,363 @@ __kernel void vertical_convolution(
             if (jy < jy1) idx_y = jy1-jy-1;
             if (jy > jy2) idx_y = IMAGE_H - (jy-jy2);
 
-            sum += input[idx_y*IMAGE_W + gidx] * filter[hlen-1 - jy];
+            sum += LOAD_TMP(gidx, idx_y + tmp_row, IMAGE_W, input) * filter[FILTER_SIZE-1 - jy];
+        }
+        int index = gidy*IMAGE_W + gidx;
+        output[index] =  sum;
+        dogs[(dog * (int) get_global_size(2) + frame)*IMAGE_W*IMAGE_H + index] = previous[index] - sum;
+    }
+}
+
+
+///
+/// Horizontal convolution using a tile in local memory
+///
+/// Each workgroup loads once the segment of lines it needs (its width plus
+/// the width of the filter) into local memory, then all work-items read
+/// their neighbours from there instead of global memory.
+/// tile must be allocated with (local_size(0) + hlen - 1) * local_size(1) floats.
+///
+
+__kernel void horizontal_convolution_local(
+    const __global float * input,  // input array
+    TMP_OUT output, // output array (temporary buffer)
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    int hlen,       // filter size
+    __local float * tile, // local buffer of (wg0 + hlen - 1) * wg1 floats
+    int IMAGE_W,
+    int IMAGE_H
+)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    input += frame * IMAGE_W * IMAGE_H;
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+    int wg = (int) get_local_size(0);
+    int c = (FILTER_SIZE & 1) ? FILTER_SIZE/2 : FILTER_SIZE/2 - 1; // even kernel size : center is shifted to the left
+    int tile_w = wg + FILTER_SIZE - 1;
+    int start = (int) get_group_id(0) * wg - c;
+
+    if (gidy < IMAGE_H) {
+        for (int i = lidx; i < tile_w; i += wg) {
+            // boundaries extension by symmetry
+            int idx_x = start + i;
+            if (idx_x < 0) idx_x = - idx_x - 1;
+            if (idx_x >= IMAGE_W) idx_x = 2 * IMAGE_W - idx_x - 1;
+            idx_x = clamp(idx_x, 0, IMAGE_W - 1);
+            tile[lidy * tile_w + i] = input[gidy*IMAGE_W + idx_x];
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W) {
+        float sum = 0.0f;
+        for (int jx = 0; jx < FILTER_SIZE; jx++) {
+            sum += tile[lidy * tile_w + lidx + jx] * filter[FILTER_SIZE-1 - jx];
+        }
+        STORE_TMP(sum, gidx, gidy + tmp_row, IMAGE_W, output);
+    }
+}
+
+
+///
+/// Vertical convolution using a tile in local memory
+///
+/// Needs a 2D workgroup. tile must be allocated with
+/// (local_size(1) + hlen - 1) * local_size(0) floats.
+///
+
+__kernel void vertical_convolution_local(
+    TMP_IN input,  // input array (temporary buffer)
+    __global float * output, // output array
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    int hlen,       // filter size
+    __local float * tile, // local buffer of (wg1 + hlen - 1) * wg0 floats
+    int IMAGE_W,
+    int IMAGE_H
+)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    output += frame * IMAGE_W * IMAGE_H;
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+    int wg0 = (int) get_local_size(0);
+    int wg1 = (int) get_local_size(1);
+    int c = (FILTER_SIZE & 1) ? FILTER_SIZE/2 : FILTER_SIZE/2 - 1; // even kernel size : center is shifted to the left
+    int tile_h = wg1 + FILTER_SIZE - 1;
+    int start = (int) get_group_id(1) * wg1 - c;
+
+    if (gidx < IMAGE_W) {
+        for (int i = lidy; i < tile_h; i += wg1) {
+            // boundaries extension by symmetry
+            int idx_y = start + i;
+            if (idx_y < 0) idx_y = - idx_y - 1;
+            if (idx_y >= IMAGE_H) idx_y = 2 * IMAGE_H - idx_y - 1;
+            idx_y = clamp(idx_y, 0, IMAGE_H - 1);
+            tile[i * wg0 + lidx] = LOAD_TMP(gidx, idx_y + tmp_row, IMAGE_W, input);
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W) {
+        float sum = 0.0f;
+        for (int jy = 0; jy < FILTER_SIZE; jy++) {
+            sum += tile[(lidy + jy) * wg0 + lidx] * filter[FILTER_SIZE-1 - jy];
         }
         output[gidy*IMAGE_W + gidx] =  sum;
     }
 }
 
 
+///
+/// Vertical convolution using a tile in local memory, fused with the DoG
+///
+
+__kernel void vertical_convolution_and_subtract_local(
+    TMP_IN input,  // input array (result of the horizontal pass)
+    const __global float * previous, // previous blurred image
+    __global float * output, // output array
+    __global float * dogs, // vector of all DoGs
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    int hlen,       // filter size
+    int dog,        // index of the DoG to write
+    __local float * tile, // local buffer of (wg1 + hlen - 1) * wg0 floats
+    int IMAGE_W,
+    int IMAGE_H
+)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    output += frame * IMAGE_W * IMAGE_H;
+    previous += frame * IMAGE_W * IMAGE_H;
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+    int wg0 = (int) get_local_size(0);
+    int wg1 = (int) get_local_size(1);
+    int c = (FILTER_SIZE & 1) ? FILTER_SIZE/2 : FILTER_SIZE/2 - 1; // even kernel size : center is shifted to the left
+    int tile_h = wg1 + FILTER_SIZE - 1;
+    int start = (int) get_group_id(1) * wg1 - c;
+
+    if (gidx < IMAGE_W) {
+        for (int i = lidy; i < tile_h; i += wg1) {
+            // boundaries extension by symmetry
+            int idx_y = start + i;
+            if (idx_y < 0) idx_y = - idx_y - 1;
+            if (idx_y >= IMAGE_H) idx_y = 2 * IMAGE_H - idx_y - 1;
+            idx_y = clamp(idx_y, 0, IMAGE_H - 1);
+            tile[i * wg0 + lidx] = LOAD_TMP(gidx, idx_y + tmp_row, IMAGE_W, input);
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W) {
+        float sum = 0.0f;
+        for (int jy = 0; jy < FILTER_SIZE; jy++) {
+            sum += tile[(lidy + jy) * wg0 + lidx] * filter[FILTER_SIZE-1 - jy];
+        }
+        int index = gidy*IMAGE_W + gidx;
+        output[index] =  sum;
+        dogs[(dog * (int) get_global_size(2) + frame)*IMAGE_W*IMAGE_H + index] = previous[index] - sum;
+    }
+}
+
+
+///
+/// Vertical convolution fused with the DoG and with the shrink
+///
+/// Same as vertical_convolution_and_subtract, but also stores every other
+/// pixel of every other line in "shrunk", the (IMAGE_W/2, IMAGE_H/2) base
+/// image of the next octave. This replaces preprocess.shrink.
+///
+
+__kernel void vertical_convolution_and_subtract_shrink(
+    TMP_IN input,  // input array (result of the horizontal pass)
+    const __global float * previous, // previous blurred image
+    __global float * output, // output array
+    __global float * dogs, // vector of all DoGs
+    __global float * shrunk, // subsampled output, for the next octave
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    int hlen,       // filter size
+    int dog,        // index of the DoG to write
+    int IMAGE_W,
+    int IMAGE_H
+)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    output += frame * IMAGE_W * IMAGE_H;
+    previous += frame * IMAGE_W * IMAGE_H;
+    shrunk += frame * (IMAGE_W / 2) * (IMAGE_H / 2);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W) {
+
+        int c, hL, hR;
+        if (FILTER_SIZE & 1) { // odd kernel size
+            c = FILTER_SIZE/2;
+            hL = c;
+            hR = c;
+        }
+        else { // even kernel size : center is shifted to the left
+            c = FILTER_SIZE/2 - 1;
+            hL = c;
+            hR = c+1;
+        }
+        int jy1 = c - gidy;
+        int jy2 = IMAGE_H - 1 - gidy + c;
+        float sum = 0.0f;
+
+        // Convolution with boundaries extension
+        for (int jy = 0; jy <= hR+hL; jy++) {
+            int idx_y = gidy - c + jy;
+            if (jy < jy1) idx_y = jy1-jy-1;
+            if (jy > jy2) idx_y = IMAGE_H - (jy-jy2);
+
+            sum += LOAD_TMP(gidx, idx_y + tmp_row, IMAGE_W, input) * filter[FILTER_SIZE-1 - jy];
+        }
+        int index = gidy*IMAGE_W + gidx;
+        output[index] =  sum;
+        dogs[(dog * (int) get_global_size(2) + frame)*IMAGE_W*IMAGE_H + index] = previous[index] - sum;
+
+        int small_w = IMAGE_W / 2;
+        if (!(gidx & 1) && !(gidy & 1) && (gidx / 2 < small_w) && (gidy / 2 < IMAGE_H / 2)) {
+            shrunk[(gidy / 2) * small_w + gidx / 2] = sum;
+        }
+    }
+}
+
+
+///
+/// Vertical convolution using a tile in local memory, fused with the DoG and with the shrink
+///
+
+__kernel void vertical_convolution_and_subtract_shrink_local(
+    TMP_IN input,  // input array (result of the horizontal pass)
+    const __global float * previous, // previous blurred image
+    __global float * output, // output array
+    __global float * dogs, // vector of all DoGs
+    __global float * shrunk, // subsampled output, for the next octave
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    int hlen,       // filter size
+    int dog,        // index of the DoG to write
+    __local float * tile, // local buffer of (wg1 + hlen - 1) * wg0 floats
+    int IMAGE_W,
+    int IMAGE_H
+)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    output += frame * IMAGE_W * IMAGE_H;
+    previous += frame * IMAGE_W * IMAGE_H;
+    shrunk += frame * (IMAGE_W / 2) * (IMAGE_H / 2);
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+    int wg0 = (int) get_local_size(0);
+    int wg1 = (int) get_local_size(1);
+    int c = (FILTER_SIZE & 1) ? FILTER_SIZE/2 : FILTER_SIZE/2 - 1; // even kernel size : center is shifted to the left
+    int tile_h = wg1 + FILTER_SIZE - 1;
+    int start = (int) get_group_id(1) * wg1 - c;
+
+    if (gidx < IMAGE_W) {
+        for (int i = lidy; i < tile_h; i += wg1) {
+            // boundaries extension by symmetry
+            int idx_y = start + i;
+            if (idx_y < 0) idx_y = - idx_y - 1;
+            if (idx_y >= IMAGE_H) idx_y = 2 * IMAGE_H - idx_y - 1;
+            idx_y = clamp(idx_y, 0, IMAGE_H - 1);
+            tile[i * wg0 + lidx] = LOAD_TMP(gidx, idx_y + tmp_row, IMAGE_W, input);
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W) {
+        float sum = 0.0f;
+        for (int jy = 0; jy < FILTER_SIZE; jy++) {
+            sum += tile[(lidy + jy) * wg0 + lidx] * filter[FILTER_SIZE-1 - jy];
+        }
+        int index = gidy*IMAGE_W + gidx;
+        output[index] =  sum;
+        dogs[(dog * (int) get_global_size(2) + frame)*IMAGE_W*IMAGE_H + index] = previous[index] - sum;
+
+        int small_w = IMAGE_W / 2;
+        if (!(gidx & 1) && !(gidy & 1) && (gidx / 2 < small_w) && (gidy / 2 < IMAGE_H / 2)) {
+            shrunk[(gidy / 2) * small_w + gidx / 2] = sum;
+        }
+    }
+}
+
+
+///
+/// Horizontal convolution with vectorized loads
+///
+/// Each work-item calculates 4 consecutive pixels of a line, so the
+/// global size along the fast dim is (IMAGE_W + 3) / 4. Far from the
+/// borders one float4 is loaded per tap instead of 4 floats.
+///
 
+inline int mirror_index(int idx, int size)
+{
+    // boundaries extension by symmetry
+    if (idx < 0) idx = - idx - 1;
+    if (idx >= size) idx = 2 * size - idx - 1;
+    return clamp(idx, 0, size - 1);
+}
 
+__kernel void horizontal_convolution_vec4(
+    const __global float * input,  // input array
+    TMP_OUT output, // output array (temporary buffer)
+    __constant float * filter __attribute__((max_constant_size(MAX_CONST_SIZE))), // filter coefficients
+    int hlen,       // filter size
+    int IMAGE_W,
+    int IMAGE_H
+)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = 4 * (int) get_global_id(0); // first of the 4 pixels
+    int frame = (int) get_global_id(2); // index of the image in the stack
+    int tmp_row = frame * IMAGE_H; // first line of the frame in the temporary buffer
+    input += frame * IMAGE_W * IMAGE_H;
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W) {
+        int c = (FILTER_SIZE & 1) ? FILTER_SIZE/2 : FILTER_SIZE/2 - 1; // even kernel size : center is shifted to the left
+        const __global float * line = input + gidy*IMAGE_W;
+        float4 sum = (float4)(0.0f, 0.0f, 0.0f, 0.0f);
 
+        if ((gidx - c >= 0) && (gidx + 3 - c + FILTER_SIZE - 1 < IMAGE_W)) {
+            for (int jx = 0; jx < FILTER_SIZE; jx++) {
+                sum += vload4(0, line + gidx - c + jx) * filter[FILTER_SIZE-1 - jx];
+            }
+        }
+        else {
+            for (int jx = 0; jx < FILTER_SIZE; jx++) {
+                int idx_x = gidx - c + jx;
+                float4 values = (float4)(line[mirror_index(idx_x, IMAGE_W)],
+                                         line[mirror_index(idx_x + 1, IMAGE_W)],
+                                         line[mirror_index(idx_x + 2, IMAGE_W)],
+                                         line[mirror_index(idx_x + 3, IMAGE_W)]);
+                sum += values * filter[FILTER_SIZE-1 - jx];
+            }
+        }
+#if !defined(IMAGE_TMP) && !defined(HALF_TMP)
+        if (gidx + 3 < IMAGE_W) {
+            vstore4(sum, 0, output + (gidy + tmp_row)*IMAGE_W + gidx);
+            return;
+        }
+#endif
+        STORE_TMP(sum.s0, gidx, gidy + tmp_row, IMAGE_W, output);
+        if (gidx + 1 < IMAGE_W) STORE_TMP(sum.s1, gidx + 1, gidy + tmp_row, IMAGE_W, output);
+        if (gidx + 2 < IMAGE_W) STORE_TMP(sum.s2, gidx + 2, gidy + tmp_row, IMAGE_W, output);
+        if (gidx + 3 < IMAGE_W) STORE_TMP(sum.s3, gidx + 3, gidy + tmp_row, IMAGE_W, output);
+    }
+}
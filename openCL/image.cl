@@ -90,6 +90,10 @@ __kernel void compute_gradient_orientation(
  *	-The output have to be Memset to (-1,-1,-1,-1)
  *	-This kernel must not be launched with s = 0 or s = nb_of_dogs (=4 for SIFT)
  *
+ * Stacks of frames are processed with a third dimension in the global size, with the DoGs
+ * laid out as in convolution.cl: DoG s of frame z starts at (s*nframes + z)*width*height.
+ * Frame z has its own counter (counter[z]) and its own segment of nb_keypoints in output.
+ *
  * :param DOGS: Pointer to global memory with ALL the coutiguously pre-allocated Differences of Gaussians
  * :param border_dist: integer, distance between inner image and borders (SIFT takes 5)
  * :param peak_thresh: float, threshold (SIFT takes 255.0 * 0.04 / 3.0)
@@ -133,14 +137,18 @@ __kernel void local_maxmin(
 
 	int gid1 = (int) get_global_id(1);
 	int gid0 = (int) get_global_id(0);
+	int frame = (int) get_global_id(2); // index of the image in the stack
+	int nframes = (int) get_global_size(2);
+	counter += frame;
+	output += frame * nb_keypoints;
 	/*
 		As the DOGs are contiguous, we have to test if (gid0,gid1) is actually in DOGs[s]
 	*/
 
 	if ((gid1 < height - border_dist) && (gid0 < width - border_dist) && (gid1 >= border_dist) && (gid0 >= border_dist)) {
-		int index_dog_prev = (scale-1)*(width*height);
-		int index_dog =scale*(width*height);
-		int index_dog_next =(scale+1)*(width*height);
+		int index_dog_prev = ((scale-1)*nframes + frame)*(width*height);
+		int index_dog = (scale*nframes + frame)*(width*height);
+		int index_dog_next = ((scale+1)*nframes + frame)*(width*height);
 
 		float res = 0.0f;
 		float val = DOGS[index_dog + gid0 + width*gid1];
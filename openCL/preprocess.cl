@@ -174,6 +174,44 @@ s64_to_float(    __global long *array_int,
     }//end test in image
 }//end kernel
 
+/**
+ * \brief Cast values of an integer array into a float output array, normalized between 0 and max_out (255).
+ *
+ * Same as <type>_to_float followed by normalizes, in a single pass. The minimum
+ * and maximum have to be calculated on the raw array (reductions with -D DTYPE).
+ *
+ * :param array_int:    Pointer to global memory with the input data
+ * :param array_float:  Pointer to global memory with the output data as float array
+ * :param min_in:       Minimum value in the input array
+ * :param max_in:       Maximum value in the input array
+ * :param max_out:      Maximum value in the output array (255 adviced)
+ * :param IMAGE_W:      Width of the image
+ * :param IMAGE_H:      Height of the image
+ */
+#define TO_FLOAT_NORMALIZED(name, type)                                                   \
+__kernel void                                                                            \
+name(    __global type *array_int,                                                       \
+         __global float *array_float,                                                    \
+         __constant float * min_in __attribute__((max_constant_size(MAX_CONST_SIZE))),   \
+         __constant float * max_in __attribute__((max_constant_size(MAX_CONST_SIZE))),   \
+         __constant float * max_out __attribute__((max_constant_size(MAX_CONST_SIZE))),  \
+         const int IMAGE_W,                                                              \
+         const int IMAGE_H                                                               \
+)                                                                                        \
+{                                                                                        \
+    if ((get_global_id(0)<IMAGE_W) && (get_global_id(1) < IMAGE_H)){                     \
+        int i = get_global_id(0) + IMAGE_W * get_global_id(1);                           \
+        array_float[i] = max_out[0]*((float)array_int[i]-min_in[0])/(max_in[0]-min_in[0]); \
+    }                                                                                    \
+}
+
+TO_FLOAT_NORMALIZED(u8_to_float_normalized, unsigned char)
+TO_FLOAT_NORMALIZED(u16_to_float_normalized, unsigned short)
+TO_FLOAT_NORMALIZED(u32_to_float_normalized, unsigned int)
+TO_FLOAT_NORMALIZED(u64_to_float_normalized, unsigned long)
+TO_FLOAT_NORMALIZED(s32_to_float_normalized, int)
+TO_FLOAT_NORMALIZED(s64_to_float_normalized, long)
+
 /**
  * \brief convert values of an array of float64 into a float output array.
  *
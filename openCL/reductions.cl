@@ -41,8 +41,13 @@
 #endif
 
 
+// Type of the input data, float unless the raw image is reduced (i.e. -D DTYPE=uchar)
+#ifndef DTYPE
+	#define DTYPE float
+#endif
+
 #define REDUCE(a, b) ((float2)(fmax(a.x,b.x),fmin(a.y,b.y)))
-#define READ_AND_MAP(i) ((float2)(data[i],data[i]))
+#define READ_AND_MAP(i) ((float2)((float)data[i],(float)data[i]))
 
 /**
  * \brief max_min_global_stage1: Look for the maximum an the minimum of an array. stage1
@@ -51,7 +56,7 @@
  * optimal total item size:  (workgroup size)^2
  * if SIZE >total item size: adjust seq_count.
  *
- * :param data:       Float pointer to global memory storing the vector of data.
+ * :param data:       Pointer to global memory storing the vector of data (of type DTYPE).
  * :param out:    	  Float2 pointer to global memory storing the temporary results (workgroup size)
  * :param seq_count:  how many blocksize each thread should read
  * :param SIZE:		  size of the
@@ -60,7 +65,7 @@
 
 
 __kernel void max_min_global_stage1(
-		__global const float *data,
+		__global const DTYPE *data,
 		__global float2 *out,
 		unsigned int SIZE){
 
@@ -207,7 +212,7 @@ __kernel void max_min_global_stage2(
  *
  * It has to be launched with WG=1 and only 1 WG has to be launched !
  *
- * :param data:       Float pointer to global memory storing the vector of data.
+ * :param data:       Pointer to global memory storing the vector of data (of type DTYPE).
  * :param SIZE:		  size of the
  * :param maximum:    Float pointer to global memory storing the maximum value
  * :param minumum:    Float pointer to global memory storing the minimum value
@@ -215,18 +220,18 @@ __kernel void max_min_global_stage2(
  *
  */
 kernel void max_min_serial(
-		global const float *data,
+		global const DTYPE *data,
 		unsigned int SIZE,
 		global float *maximum,
 		global float *minimum)
 {
 float value, maxi, mini;
-value = data[0];
+value = (float)data[0];
 mini = value;
 maxi = value;
 for (int i=1; i<SIZE; i++)
 {
-	value = data[i];
+	value = (float)data[i];
 	if (value>maxi)
 		maxi = value;
 	if (value<mini)
@@ -53,19 +53,120 @@ __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 __date__ = "03/11/2016"
 __status__ = "beta"
 
+import os
 import time
 import math
+import hashlib
+import tempfile
 import logging
 import threading
 import gc
+import collections
 import numpy
 from .param import par
 from .clinit import ocl, pyopencl, kernel_workgroup_size
-from clutils import get_opencl_code, nextpower
+from clutils import get_opencl_code
 
-from .utils import calc_size, kernel_size
+from .utils import calc_size, kernel_size, nextpower
 logger = logging.getLogger("sift.plan")
 
+# Directory where compiled OpenCL programs are stored, disabled (None) unless
+# the environment variable SIFT_PYOCL_BINARY_CACHE provides one.
+# pyopencl already caches the builds of Program(...).build(): this one is only
+# meant for setups where pyopencl's cache is disabled or not persistent.
+BINARY_CACHE = os.environ.get("SIFT_PYOCL_BINARY_CACHE") or None
+
+# Device buffers released by former plans (created with pool_buffers=True), to be reused by the next ones.
+# key: (context, shape, dtype), value: list of pyopencl arrays; keys are kept in least recently used order
+_BUFFER_POOL = collections.OrderedDict()
+_BUFFER_POOL_LOCK = threading.Lock()
+BUFFER_POOL_MAX = 512 * 2 ** 20  # maximum size in bytes of the buffers kept in the pool
+_buffer_pool_bytes = [0]  # current size of the pool, in a list to be modified in place
+
+
+def buffer_pool_size():
+    """Size in bytes of the device buffers kept for reuse by SiftPlan instances
+    """
+    return _buffer_pool_bytes[0]
+
+
+def clear_buffer_pool():
+    """Release all device buffers kept for reuse by SiftPlan instances
+    """
+    with _BUFFER_POOL_LOCK:
+        _BUFFER_POOL.clear()
+        _buffer_pool_bytes[0] = 0
+    gc.collect()
+
+
+def _pool_release(key, ary):
+    """Put a device buffer in the pool, evicting the least recently used ones above BUFFER_POOL_MAX
+
+    :param key: (context, shape, dtype) of the buffer
+    :param ary: pyopencl array, not bound to any queue
+    """
+    with _BUFFER_POOL_LOCK:
+        if ary.nbytes > BUFFER_POOL_MAX:
+            return
+        pool = _BUFFER_POOL.pop(key, [])
+        pool.append(ary)
+        _BUFFER_POOL[key] = pool
+        _buffer_pool_bytes[0] += ary.nbytes
+        while _buffer_pool_bytes[0] > BUFFER_POOL_MAX:
+            oldest = next(iter(_BUFFER_POOL))
+            evicted = _BUFFER_POOL[oldest].pop(0)
+            if not _BUFFER_POOL[oldest]:
+                del _BUFFER_POOL[oldest]
+            _buffer_pool_bytes[0] -= evicted.nbytes
+
+
+def _pool_acquire(key):
+    """Take a device buffer from the pool
+
+    :param key: (context, shape, dtype) of the buffer
+    :return: pyopencl array or None if there is none of this kind
+    """
+    with _BUFFER_POOL_LOCK:
+        pool = _BUFFER_POOL.get(key)
+        if not pool:
+            return None
+        ary = pool.pop()
+        if not pool:
+            del _BUFFER_POOL[key]
+        _buffer_pool_bytes[0] -= ary.nbytes
+        return ary
+
+# Blur schedules, shared by all plans with the same parameters
+_SIGMA_LADDERS = {}
+
+
+def sigma_ladder(init_sigma, sigma_ratio, nb_blur, double_im_size=False):
+    """Calculate (once) the widths of all gaussian blurs and the size of their kernels
+
+    :param init_sigma: blur of the first image of each octave
+    :param sigma_ratio: ratio between the blurs of two consecutive scales
+    :param nb_blur: number of blurs in one octave (par.Scales + 2)
+    :param double_im_size: True if the input is considered as already blurred by 1.0 instead of 0.5
+    :return: ((sigma, size) of the initial blur or None, tuple of (sigma, size) for each scale)
+    """
+    key = (init_sigma, sigma_ratio, nb_blur, bool(double_im_size))
+    ladder = _SIGMA_LADDERS.get(key)
+    if ladder is None:
+        curSigma = 1.0 if double_im_size else 0.5
+        if init_sigma > curSigma:
+            sigma = math.sqrt(init_sigma ** 2 - curSigma ** 2)
+            init_blur = (sigma, kernel_size(sigma, True))
+        else:
+            init_blur = None
+        blurs = []
+        prevSigma = init_sigma
+        for i in range(nb_blur):
+            increase = prevSigma * math.sqrt(sigma_ratio ** 2 - 1.0)
+            blurs.append((increase, kernel_size(increase, True)))
+            prevSigma *= sigma_ratio
+        ladder = _SIGMA_LADDERS[key] = (init_blur, tuple(blurs))
+    return ladder
+
 
 class SiftPlan(object):
     """
@@ -104,9 +205,19 @@ class SiftPlan(object):
                  numpy.dtype(numpy.int64):"s64_to_float",
                  # numpy.dtype(numpy.float64): "double_to_float",
                  }
+    cl_types = {numpy.dtype(numpy.uint8): "uchar",  # OpenCL type of raw input, for reductions
+                numpy.dtype(numpy.uint16): "ushort",
+                numpy.dtype(numpy.uint32): "uint",
+                numpy.dtype(numpy.uint64): "ulong",
+                numpy.dtype(numpy.int32): "int",
+                numpy.dtype(numpy.int64): "long",
+                }
 
     sigmaRatio = 2.0 ** (1.0 / par.Scales)
     PIX_PER_KP = 10  # pre_allocate buffers for keypoints
+    HALF_TMP = False  # store the intermediate image of the separable convolution in half precision
+    IMAGE_TMP = False  # store the intermediate image of the separable convolution in an OpenCL image
+    POOL_BUFFERS = False  # give device buffers back to a pool shared by the plans on the same context
     dtype_kp = numpy.dtype([('x', numpy.float32),
                             ('y', numpy.float32),
                             ('scale', numpy.float32),
@@ -116,7 +227,8 @@ class SiftPlan(object):
 
     def __init__(self, shape=None, dtype=None, devicetype="CPU", template=None,
                  profile=False, device=None, PIX_PER_KP=None,
-                 max_workgroup_size=None, context=None, init_sigma=None):
+                 max_workgroup_size=None, context=None, init_sigma=None,
+                 half_tmp=None, image_tmp=None, pool_buffers=None):
         """
         Constructor of the class
 
@@ -129,12 +241,17 @@ class SiftPlan(object):
         :param PIX_PER_KP: number of keypoint pre-allocated: 1 for 10 pixel
         :param max_workgroup_size: set to 1 under macosX on CPU
         :param context: provide an external context
+        :param half_tmp: store the temporary image of the gaussian blur in float16
+        :param image_tmp: store the temporary image of the gaussian blur in an image2d (texture cache)
+        :param pool_buffers: reuse the device buffers of former plans on the same (external) context
         """
         if init_sigma is None:
             init_sigma = par.InitSigma
         # no test on the values, just make sure it is a float
         self._init_sigma = float(init_sigma)
+        self.init_blur, self.blurs = sigma_ladder(self._init_sigma, self.sigmaRatio, par.Scales + 2, par.DoubleImSize)
         self.buffers = {}
+        self._pooled = set()  # name of the buffers to be returned to the pool
         self.programs = {}
         if template is not None:
             self.shape = template.shape
@@ -151,13 +268,33 @@ class SiftPlan(object):
             raise RuntimeError("Unable to process image of shape %s" % (tuple(self.shape,)))
         if PIX_PER_KP:
             self.PIX_PER_KP = int(PIX_PER_KP)
+        if half_tmp is not None:
+            self.HALF_TMP = bool(half_tmp)
+        if image_tmp is not None:
+            self.IMAGE_TMP = bool(image_tmp)
+        if pool_buffers is not None:
+            self.POOL_BUFFERS = bool(pool_buffers)
+        if not context:
+            # nobody else will ever use the buffers of a private context
+            self.POOL_BUFFERS = False
         self.profile = bool(profile)
         self.events = []
         self._sem = threading.Semaphore()
         self.scales = []  # in XY order
         self.procsize = []  # same as  procsize but with dimension in (X,Y) not (slow, fast)
         self.wgsize = []
+        self.procsize_2d = []  # for kernels needing square-ish workgroups, like vertical_convolution_local
+        self.wgsize_2d = []
+        self.procsize_vec4 = []  # for horizontal_convolution_vec4, 4 pixels per work-item
+        self.wgsize_vec4 = []
+        self.local_convolution = False
+        self.vec4_convolution = False
+        self.conv_kernels = {}  # ksize -> {function_name: kernel}, bound once to avoid lookups per launch
+        self.conv_workgroups = {}  # ksize -> {function_name: max workgroup size of the specialized kernel}
         self.kpsize = None
+        self.host_view = None  # numpy view on the page-locked input buffer
+        self._input_evt = None  # pending transfer from host_view to the device
+        self.unified_memory = False  # device and host share the same memory
         self.memory = None
         self.octave_max = None
         self.red_size = None
@@ -187,6 +324,17 @@ class SiftPlan(object):
         else:
             self.queue = pyopencl.CommandQueue(self.ctx)
         ocldevice = ocl.platforms[self.device[0]].devices[self.device[1]]
+        if self.IMAGE_TMP:
+            cldevice = self.ctx.devices[0]
+            if not (cldevice.image_support and
+                    cldevice.image2d_max_width >= self.shape[1] and
+                    cldevice.image2d_max_height >= self.shape[0]):
+                logger.warning("Device %s is unable to store an image of shape %s: disabling IMAGE_TMP", ocldevice, self.shape)
+                self.IMAGE_TMP = False
+        try:
+            self.unified_memory = bool(self.ctx.devices[0].host_unified_memory)
+        except (AttributeError, pyopencl.Error):
+            self.unified_memory = False
         self._calc_workgroups()
         self._compile_kernels()
         self._allocate_buffers()
@@ -199,6 +347,16 @@ class SiftPlan(object):
             self.USE_CPU = False
             if "HD Graphics" in ocldevice.name:
                 self.LOW_END = 2
+        # Tiled convolution in local memory: worth it only on GPU, and only if workgroups fit
+        # (checked again at launch against the kernels specialized for each filter size)
+        self.local_convolution = ((not self.USE_CPU) and bool(self.wgsize) and
+                                  max(i[0] for i in self.wgsize) <= self.kernels.get("convolution.horizontal_convolution_local", 0) and
+                                  max(i[0] * i[1] for i in self.wgsize_2d) <= min(self.kernels.get("convolution.vertical_convolution_local", 0),
+                                                                                   self.kernels.get("convolution.vertical_convolution_and_subtract_local", 0),
+                                                                                   self.kernels.get("convolution.vertical_convolution_and_subtract_shrink_local", 0)))
+        # Otherwise the horizontal pass reads the image by float4
+        self.vec4_convolution = ((not self.local_convolution) and bool(self.wgsize_vec4) and
+                                 max(i[0] for i in self.wgsize_vec4) <= self.kernels.get("convolution.horizontal_convolution_vec4", 0))
 
     def __del__(self):
         """
@@ -239,6 +397,12 @@ class SiftPlan(object):
         nr_blur = par.Scales + 3  # 3 blurs and 2 tmp
         nr_dogs = par.Scales + 2
         self.memory += size * (nr_blur + nr_dogs) * size_of_float
+        if self.IMAGE_TMP:
+            size_of_tmp = numpy.dtype(numpy.float16 if self.HALF_TMP else numpy.float32).itemsize
+            self.memory += size * size_of_tmp  # temporary image of the convolution
+        elif self.HALF_TMP:
+            size_of_half = numpy.dtype(numpy.float16).itemsize
+            self.memory += size * size_of_half  # temporary buffer of the convolution
 
         self.kpsize = int(self.shape[0] * self.shape[1] // self.PIX_PER_KP)  # Is the number of kp independant of the octave ? int64 causes problems with pyopencl
         self.memory += self.kpsize * size_of_float * 4 * 2  # those are array of float4 to register keypoints, we need two of them
@@ -251,19 +415,13 @@ class SiftPlan(object):
         ########################################################################
         # Calculate space for gaussian kernels
         ########################################################################
-        curSigma = 1.0 if par.DoubleImSize else 0.5
-        if self._init_sigma > curSigma:
-            sigma = math.sqrt(self._init_sigma ** 2 - curSigma ** 2)
-            size = kernel_size(sigma, True)
-            logger.debug("pre-Allocating %s float for init blur" % size)
+        if self.init_blur is not None:
+            size = self.init_blur[1]
+            logger.debug("pre-Allocating %s float for init blur", size)
             self.memory += size * size_of_float
-        prevSigma = self._init_sigma
-        for i in range(par.Scales + 2):
-            increase = prevSigma * math.sqrt(self.sigmaRatio ** 2 - 1.0)
-            size = kernel_size(increase, True)
-            logger.debug("pre-Allocating %s float for blur sigma: %s" % (size, increase))
+        for increase, size in self.blurs:
+            logger.debug("pre-Allocating %s float for blur sigma: %s", size, increase)
             self.memory += size * size_of_float
-            prevSigma *= self.sigmaRatio
 
     def _allocate_buffers(self):
         """
@@ -273,85 +431,180 @@ class SiftPlan(object):
         if self.dtype != numpy.float32:
             if self.RGB:
                 rgbshape = self.shape[0], self.shape[1], 3
-                self.buffers["raw"] = pyopencl.array.empty(self.queue, rgbshape, dtype=self.dtype)
+                self._empty("raw", rgbshape, self.dtype)
             else:
-                self.buffers["raw"] = pyopencl.array.empty(self.queue, shape, dtype=self.dtype)
-        self.buffers["Kp_1"] = pyopencl.array.empty(self.queue, (self.kpsize, 4), dtype=numpy.float32)
-        self.buffers["Kp_2"] = pyopencl.array.empty(self.queue, (self.kpsize, 4), dtype=numpy.float32)
-        self.buffers["descr"] = pyopencl.array.empty(self.queue, (self.kpsize, 128), dtype=numpy.uint8)
-        self.buffers["cnt"] = pyopencl.array.empty(self.queue, 1, dtype=numpy.int32)
-        self.buffers["descriptors"] = pyopencl.array.empty(self.queue, (self.kpsize, 128), dtype=numpy.uint8)
-
-        self.buffers["tmp"] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
-        self.buffers["ori"] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
+                self._empty("raw", shape, self.dtype)
+        self._empty("Kp_1", (self.kpsize, 4), numpy.float32)
+        self._empty("Kp_2", (self.kpsize, 4), numpy.float32)
+        self._empty("descr", (self.kpsize, 128), numpy.uint8)
+        self._empty("cnt", 1, numpy.int32)
+        self._empty("descriptors", (self.kpsize, 128), numpy.uint8)
+
+        self._empty("tmp", shape, numpy.float32)
+        if self.IMAGE_TMP:
+            channel_type = pyopencl.channel_type.HALF_FLOAT if self.HALF_TMP else pyopencl.channel_type.FLOAT
+            self.buffers["tmp_image"] = pyopencl.Image(self.ctx, pyopencl.mem_flags.READ_WRITE,
+                                                       pyopencl.ImageFormat(pyopencl.channel_order.R, channel_type),
+                                                       shape=(shape[1], shape[0]))
+        elif self.HALF_TMP:
+            self._empty("tmp_half", shape, numpy.float16)
+        self._empty("ori", shape, numpy.float32)
         for scale in range(par.Scales + 3):
-            self.buffers[scale] = pyopencl.array.empty(self.queue, shape, dtype=numpy.float32)
-        self.buffers["DoGs"] = pyopencl.array.empty(self.queue, (par.Scales + 2, shape[0], shape[1]), dtype=numpy.float32)
-        self.buffers["max_min"] = pyopencl.array.empty(self.queue, (self.red_size, 2), dtype=numpy.float32)  # temporary buffer for max/min reduction
-        self.buffers["min"] = pyopencl.array.empty(self.queue, (1), dtype=numpy.float32)
-        self.buffers["max"] = pyopencl.array.empty(self.queue, (1), dtype=numpy.float32)
+            self._empty(scale, shape, numpy.float32)
+        self._empty("DoGs", (par.Scales + 2, shape[0], shape[1]), numpy.float32)
+        self._empty("max_min", (self.red_size, 2), numpy.float32)  # temporary buffer for max/min reduction
+        self._empty("min", 1, numpy.float32)
+        self._empty("max", 1, numpy.float32)
         self.buffers["255"] = pyopencl.array.to_device(self.queue, numpy.array([255.0], dtype=numpy.float32))
         ########################################################################
+        # Page-locked host buffer for the input image
+        ########################################################################
+        if self.dtype in (numpy.float32, numpy.float64):
+            host_dtype = numpy.dtype(numpy.float32)
+        else:
+            host_dtype = self.dtype
+        host_shape = (shape[0], shape[1], 3) if self.RGB else tuple(shape)
+        if self.unified_memory:
+            # input buffers are mapped directly, see _copy_input
+            self.buffers["pinned"] = None
+        else:
+            try:
+                self.buffers["pinned"] = pyopencl.Buffer(self.ctx, pyopencl.mem_flags.READ_ONLY | pyopencl.mem_flags.ALLOC_HOST_PTR,
+                                                         host_dtype.itemsize * int(numpy.prod(host_shape)))
+                self.host_view, _ = pyopencl.enqueue_map_buffer(self.queue, self.buffers["pinned"], pyopencl.map_flags.WRITE,
+                                                                0, host_shape, host_dtype)
+            except pyopencl.Error as error:
+                logger.warning("Unable to allocate page-locked host buffer: %s", error)
+                self.buffers["pinned"] = None
+                self.host_view = None
+        ########################################################################
         # Allocate space for gaussian kernels
         ########################################################################
-        curSigma = 1.0 if par.DoubleImSize else 0.5
-        if self._init_sigma > curSigma:
-            sigma = math.sqrt(self._init_sigma ** 2 - curSigma ** 2)
-            self._init_gaussian(sigma)
-        prevSigma = self._init_sigma
-
-        for i in range(par.Scales + 2):
-            increase = prevSigma * math.sqrt(self.sigmaRatio ** 2 - 1.0)
-            self._init_gaussian(increase)
-            prevSigma *= self.sigmaRatio
+        sigmas = [sigma for sigma, _ in self.blurs]
+        if self.init_blur is not None:
+            sigmas.insert(0, self.init_blur[0])
+        self._init_gaussians(sigmas)
 
-    def _init_gaussian(self, sigma):
-        """Create a buffer of the right size according to the width of the gaussian ...
+    def _init_gaussians(self, sigmas):
+        """Create all gaussian kernels in a single buffer on the device.
 
+        Each kernel is accessible as buffers["gaussian_<sigma>"], a pyopencl
+        array on a sub-region of buffers["gaussians"]. Offsets are aligned
+        on the device requirement for sub-buffers.
 
-        :param  sigma: width of the gaussian, the length of the function will be 8*sigma + 1
+        :param sigmas: list of widths of the gaussian, the length of the function will be 8*sigma + 1
 
         Same calculation done on CPU
         x = numpy.arange(size) - (size - 1.0) / 2.0
         gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
         gaussian /= gaussian.sum(dtype=numpy.float32)
         """
-        name = "gaussian_%s" % sigma
-        size = kernel_size(sigma, True)
-        wg_size = nextpower(size)
-
-        logger.info("Allocating %s float for blur sigma: %s. wg=%s max_wg=%s", size, sigma,wg_size, self.max_workgroup_size)
+        size_of_float = numpy.dtype(numpy.float32).itemsize
+        # mem_base_addr_align is expressed in bits
+        align = max(1, self.ctx.devices[0].mem_base_addr_align // (8 * size_of_float))
+        # kernels are read through __constant memory in convolution.cl
+        max_const = min(self.ctx.devices[0].max_constant_buffer_size, 16384)
+        self.gauss_offsets = {}
+        total_size = 0
+        for sigma in sigmas:
+            size = kernel_size(sigma, True)
+            if size * size_of_float > max_const:
+                logger.warning("Gaussian kernel for sigma=%s (%s floats) exceeds the constant memory size of the device (%s bytes)",
+                               sigma, size, max_const)
+            self.gauss_offsets[sigma] = (total_size, size)
+            total_size += align * ((size + align - 1) // align)
+
+        gaussians = pyopencl.array.empty(self.queue, total_size, dtype=numpy.float32)
+        self.buffers["gaussians"] = gaussians
         wg1 = self.kernels["gaussian.gaussian"]
-        if wg1>=wg_size:
-            gaussian_gpu = pyopencl.array.empty(self.queue, size, dtype=numpy.float32)
-            evt = self.programs["gaussian"].gaussian(self.queue, (wg_size,), (wg_size,),
-                                                     gaussian_gpu.data,  # __global     float     *data,
-                                                     numpy.float32(sigma),  # const        float     sigma,
-                                                     numpy.int32(size))  # const        int     SIZE
-            if self.profile:
-                self.events.append(("gaussian %s" % sigma, evt))
+        max_wg = max(nextpower(size) for _, size in self.gauss_offsets.values())
+        if wg1 >= max_wg:
+            host_gaussians = None
         else:
             logger.info("Workgroup size error: gaussian wg: %s < max_work_group_size: %s",
                         wg1, self.max_workgroup_size)
             #common bug on OSX when running on CPU
-            x = numpy.arange(size) - (size - 1.0) / 2.0
-            gaus = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
-            gaus /= gaus.sum(dtype=numpy.float32)
-            gaussian_gpu = pyopencl.array.to_device(self.queue, gaus)
+            host_gaussians = self._host_gaussians(sigmas, total_size)
+
+        for sigma in sigmas:
+            offset, size = self.gauss_offsets[sigma]
+            wg_size = nextpower(size)
+            logger.info("Allocating %s float for blur sigma: %s. wg=%s max_wg=%s", size, sigma, wg_size, self.max_workgroup_size)
+            sub_buffer = gaussians.data.get_sub_region(offset * size_of_float, size * size_of_float)
+            gaussian_gpu = pyopencl.array.Array(self.queue, (size,), numpy.float32, data=sub_buffer)
+            if host_gaussians is None:
+                evt = self.programs["gaussian"].gaussian(self.queue, (wg_size,), (wg_size,),
+                                                         gaussian_gpu.data,  # __global     float     *data,
+                                                         numpy.float32(sigma),  # const        float     sigma,
+                                                         numpy.int32(size))  # const        int     SIZE
+                if self.profile:
+                    self.events.append(("gaussian %s" % sigma, evt))
+            self.buffers["gaussian_%s" % sigma] = gaussian_gpu
+            self._compile_convolution(size)
+
+        if host_gaussians is not None:
+            # single transfer for all kernels
+            gaussians.set(host_gaussians)
 
-        self.buffers[name] = gaussian_gpu
-        return gaussian_gpu
+    def _host_gaussians(self, sigmas, total_size):
+        """Calculate all gaussian kernels on the host, in a single numpy expression
+
+        :param sigmas: list of widths of the gaussian, already registered in self.gauss_offsets
+        :param total_size: size of the buffer with all kernels
+        :return: 1D float32 array with all kernels at their offset
+        """
+        offsets, sizes = numpy.array([self.gauss_offsets[sigma] for sigma in sigmas]).T
+        sig = numpy.array(sigmas, dtype=numpy.float64)[:, None]
+        pos = numpy.arange(sizes.max())[None, :]
+        mask = pos < sizes[:, None]
+        x = pos - (sizes[:, None] - 1.0) / 2.0
+        gaus = numpy.where(mask, numpy.exp(-(x / sig) ** 2 / 2.0), 0.0).astype(numpy.float32)
+        gaus /= gaus.sum(axis=-1, dtype=numpy.float32)[:, None]
+        host_gaussians = numpy.zeros(total_size, dtype=numpy.float32)
+        index = (offsets[:, None] + pos)[mask]
+        host_gaussians[index] = gaus[mask]
+        return host_gaussians
+
+    def _empty(self, name, shape, dtype):
+        """Allocate buffers[name] on the device, reusing a buffer from the pool if POOL_BUFFERS
+
+        :param name: key of the buffer in self.buffers
+        :param shape: shape of the array
+        :param dtype: data type of the array
+        :return: pyopencl array
+        """
+        if not isinstance(shape, (tuple, list)):
+            shape = (shape,)
+        key = (self.ctx, tuple(int(i) for i in shape), numpy.dtype(dtype))
+        ary = _pool_acquire(key) if self.POOL_BUFFERS else None
+        if ary is None:
+            ary = pyopencl.array.empty(self.queue, key[1], dtype=key[2])
+        else:
+            ary = ary.with_queue(self.queue)
+        self.buffers[name] = ary
+        if self.POOL_BUFFERS:
+            self._pooled.add(name)
+        return ary
 
     def _free_buffers(self):
         """free all memory allocated on the device
+
+        Buffers allocated with _empty are returned to the pool for the next plans when POOL_BUFFERS.
         """
-        for buffer_name in self.buffers:
-            if self.buffers[buffer_name] is not None:
-                try:
-                    del self.buffers[buffer_name]
-                    self.buffers[buffer_name] = None
-                except pyopencl.LogicError:
-                    logger.error("Error while freeing buffer %s" % buffer_name)
+        if getattr(self, "_input_evt", None) is not None:
+            self._input_evt.wait()
+            self._input_evt = None
+        self.host_view = None
+        pooled = getattr(self, "_pooled", set())
+        if pooled and getattr(self, "queue", None) is not None:
+            # Pending kernels may still be using them
+            self.queue.finish()
+        for buffer_name in list(self.buffers):
+            buffer_ = self.buffers.pop(buffer_name)
+            if (buffer_ is None) or (buffer_name not in pooled):
+                continue
+            _pool_release((self.ctx, buffer_.shape, buffer_.dtype), buffer_.with_queue(None))
+        pooled.clear()
 
     def _compile_kernels(self):
         """Call the OpenCL compiler
@@ -360,8 +613,11 @@ class SiftPlan(object):
             kernel_src = get_opencl_code(kernel)
             if isinstance(wg_size, tuple):
                 wg_size = self.max_workgroup_size
+            compile_options = '-D WORKGROUP_SIZE=%s' % wg_size
+            if kernel == "convolution":
+                compile_options = self._convolution_options(wg_size)
             try:
-                program = pyopencl.Program(self.ctx, kernel_src).build('-D WORKGROUP_SIZE=%s' % wg_size)
+                program = self._build_cached(kernel_src, compile_options)
             except pyopencl.MemoryError as error:
                 raise MemoryError(error)
             except pyopencl.RuntimeError as error:
@@ -378,12 +634,111 @@ class SiftPlan(object):
             for one_function in program.all_kernels():
                 workgroup_size = kernel_workgroup_size(program, one_function)
                 self.kernels[kernel+"."+one_function.function_name] = workgroup_size
+        if (not self.RGB) and (self.dtype in self.cl_types):
+            # min/max read directly from the raw input, to cast and normalize in a single pass
+            compile_options = "-D WORKGROUP_SIZE=%s -D DTYPE=%s" % (self.kernels["reductions"], self.cl_types[self.dtype])
+            try:
+                program = self._build_cached(get_opencl_code("reductions"), compile_options)
+            except pyopencl.RuntimeError as error:
+                logger.warning("Failed compiling reductions for %s: %s: cast and normalize separately", self.dtype, error)
+            else:
+                self.programs["reductions_raw"] = program
+                for one_function in program.all_kernels():
+                    self.kernels["reductions_raw." + one_function.function_name] = kernel_workgroup_size(program, one_function)
 
 
+    def _build_cached(self, kernel_src, options):
+        """Build an OpenCL program, using the binary from a former build if available
+
+        Binaries are stored in BINARY_CACHE, with a name depending on the source,
+        the options, the device and its driver. Each file starts with the sha256
+        of the binary, so that truncated or corrupted files are never given to
+        the driver. Files are written under a temporary name and renamed in
+        place, so that concurrent processes never read a partial file.
+
+        :param kernel_src: source code of the program
+        :param options: compilation options
+        :return: built pyopencl program
+        """
+        if not BINARY_CACHE:
+            return pyopencl.Program(self.ctx, kernel_src).build(options)
+        device = self.ctx.devices[0]
+        key = "\n".join((kernel_src, options, device.platform.name, device.name, device.driver_version))
+        filename = os.path.join(BINARY_CACHE, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".bin")
+        digest_size = hashlib.sha256().digest_size
+        if os.path.exists(filename):
+            try:
+                with open(filename, "rb") as f:
+                    content = f.read()
+                digest, binary = content[:digest_size], content[digest_size:]
+                if hashlib.sha256(binary).digest() == digest:
+                    return pyopencl.Program(self.ctx, [device], [binary]).build(options)
+                logger.warning("Cached program %s is corrupted: compile it again", filename)
+            except (IOError, pyopencl.Error) as error:
+                logger.warning("Unable to load cached program %s: %s", filename, error)
+        program = pyopencl.Program(self.ctx, kernel_src).build(options)
+        try:
+            if not os.path.isdir(BINARY_CACHE):
+                os.makedirs(BINARY_CACHE)
+            binary = bytes(program.get_info(pyopencl.program_info.BINARIES)[0])
+            fd, tmpname = tempfile.mkstemp(dir=BINARY_CACHE, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(hashlib.sha256(binary).digest())
+                    f.write(binary)
+                os.rename(tmpname, filename)
+            except (IOError, OSError):
+                os.remove(tmpname)
+                raise
+        except (IOError, OSError) as error:
+            logger.warning("Unable to store compiled program in %s: %s", BINARY_CACHE, error)
+        return program
+
+    def _convolution_options(self, wg_size, ksize=None):
+        """Compilation options for the convolution kernels
+
+        :param wg_size: maximum workgroup size
+        :param ksize: if provided, size of the filter hard-coded in the program
+        :return: string with the options
+        """
+        compile_options = '-D WORKGROUP_SIZE=%s' % wg_size
+        if self.IMAGE_TMP:
+            compile_options += " -D IMAGE_TMP"
+        elif self.HALF_TMP:
+            compile_options += " -D HALF_TMP"
+        if ksize is not None:
+            compile_options += " -D KSIZE=%i" % ksize
+        return compile_options
+
+    def _compile_convolution(self, ksize):
+        """Compile the convolution kernels specialized for a given filter size.
+
+        Programs are stored in self.programs as "convolution_<ksize>", only once per size.
+        On failure the generic program is used instead.
+
+        :param ksize: size of the filter
+        """
+        name = "convolution_%i" % ksize
+        if name in self.programs:
+            return self.programs[name]
+        compile_options = self._convolution_options(self.kernels["convolution"], ksize)
+        try:
+            program = self._build_cached(get_opencl_code("convolution"), compile_options)
+        except pyopencl.RuntimeError as error:
+            logger.warning("Failed compiling convolution for filter size %s: %s: use generic kernels", ksize, error)
+            program = self.programs["convolution"]
+        self.programs[name] = program
+        kernels = program.all_kernels()
+        self.conv_kernels[int(ksize)] = dict((kernel.function_name, kernel) for kernel in kernels)
+        self.conv_workgroups[int(ksize)] = dict((kernel.function_name, kernel_workgroup_size(program, kernel)) for kernel in kernels)
+        return program
+
     def _free_kernels(self):
         """free all kernels
         """
         self.programs = {}
+        self.conv_kernels = {}
+        self.conv_workgroups = {}
 
     def _calc_workgroups(self):
         """First try to guess the best workgroup size, then calculate all global worksize
@@ -427,6 +782,14 @@ class SiftPlan(object):
             wg = (min(nextpower(shape[-1]), self.max_workgroup_size), 1)
             self.wgsize.append(wg)
             self.procsize.append(calc_size(shape[-1::-1], wg))
+            wg0 = min(16, nextpower(shape[-1]), self.max_workgroup_size)
+            wg2d = (wg0, max(1, min(16, self.max_workgroup_size // wg0)))
+            self.wgsize_2d.append(wg2d)
+            self.procsize_2d.append(calc_size(shape[-1::-1], wg2d))
+            shape_vec4 = ((shape[-1] + 3) // 4, shape[0])
+            wg_vec4 = (min(nextpower(shape_vec4[0]), self.max_workgroup_size), 1)
+            self.wgsize_vec4.append(wg_vec4)
+            self.procsize_vec4.append(calc_size(shape_vec4, wg_vec4))
             shape = tuple(i // 2 for i in shape)
 
     def keypoints(self, image):
@@ -437,91 +800,77 @@ class SiftPlan(object):
         """
         self.reset_timer()
         with self._sem:
-            total_size = 0
-            keypoints = []
-            descriptors = []
             assert image.shape[:2] == self.shape
             assert image.dtype in [self.dtype, numpy.float32]
             # old versions of pyopencl do not check for data contiguity
             if not(isinstance(image, pyopencl.array.Array)) and not(image.flags["C_CONTIGUOUS"]):
                 image = numpy.ascontiguousarray(image)
-            t0 = time.time()
+            if self.profile:
+                t0 = time.time()
 
-            if image.dtype == numpy.float32:
-                if isinstance(image, pyopencl.array.Array):
-                    evt = pyopencl.enqueue_copy(self.queue, self.buffers[0].data, image.data)
-                else:
-                    evt = pyopencl.enqueue_copy(self.queue, self.buffers[0].data, image)
-                if self.profile:
-                    self.events.append(("copy H->D", evt))
-            elif self.dtype == numpy.float64:
-                # A preprocessing kernel double_to_float exists, but is commented (RUNS ONLY ON GPU WITH FP64)
-                # TODO: benchmark this kernel vs the current pure CPU format conversion with numpy.float32
-                #       and uncomment it if it proves faster (dubious, because of data transfer bottleneck)
-                evt = pyopencl.enqueue_copy(self.queue, self.buffers[0].data, image.astype(numpy.float32))
-                if self.profile:
-                    self.events.append(("copy H->D", evt))
-            elif (len(image.shape) == 3) and (image.dtype == numpy.uint8) and (self.RGB):
-                if isinstance(image, pyopencl.array.Array):
-                    evt = pyopencl.enqueue_copy(self.queue, self.buffers["raw"].data, image.data)
-                else:
-                    evt = pyopencl.enqueue_copy(self.queue, self.buffers["raw"].data, image)
-                if self.profile:
-                    self.events.append(("copy H->D", evt))
+            buffer_ = self._input_buffer(image.dtype)
+            self._copy_input(image, buffer_)
+            output = self._keypoints_on_device(buffer_)
+            if self.profile:
+                logger.info("Execution time: %.3fms", 1000 * (time.time() - t0))
+        return output
 
-                evt = self.programs["preprocess"].rgb_to_float(self.queue, self.procsize[0], self.wgsize[0],
-                                                               self.buffers["raw"].data, self.buffers[0].data,
-                                                               *self.scales[0])
-                if self.profile:
-                    self.events.append(("RGB -> float", evt))
+    __call__ = keypoints
 
-            elif self.dtype in self.converter:
-                program = self.programs["preprocess"].__getattr__(self.converter[self.dtype])
-                evt = pyopencl.enqueue_copy(self.queue, self.buffers["raw"].data, image)
-                if self.profile:
-                    self.events.append(("copy H->D", evt))
-                evt = program(self.queue, self.procsize[0], self.wgsize[0],
-                              self.buffers["raw"].data, self.buffers[0].data, *self.scales[0])
-                if self.profile:
-                    self.events.append(("convert -> float", evt))
-            else:
-                raise RuntimeError("invalid input format error (%s)" % (str(self.dtype)))
-
-            wg1 = self.kernels["reductions.max_min_global_stage1"]
-            wg2 = self.kernels["reductions.max_min_global_stage2"]
-            if min(wg1, wg2) < self.red_size:
-                #common bug on OSX when running on CPU
-                logger.info("Unable to use MinMax Reduction: stage1 wg: %s; stage2 wg: %s < max_work_group_size: %s, expected: %s",
-                            wg1, wg2, self.max_workgroup_size, self.red_size)
-                kernel = self.programs["reductions"].max_min_serial
-                k = kernel(self.queue, (1,), (1,),
-                               self.buffers[0].data,
-                               numpy.uint32(self.shape[0] * self.shape[1]),
-                               self.buffers["max"].data,
-                               self.buffers["min"].data)
-                if self.profile:
-                    self.events.append(("max_min_serial", k))
-                #python implementation:
-                #buffer_ = self.buffers[0].get()
-                #self.buffers["max"].set(numpy.array([buffer_.max()], dtype=numpy.float32))
-                #self.buffers["min"].set(numpy.array([buffer_.min()], dtype=numpy.float32))
-            else:
-                kernel1 = self.programs["reductions"].max_min_global_stage1
-                kernel2 = self.programs["reductions"].max_min_global_stage2
-                #logger.debug("self.red_size: %s", self.red_size)
-                k1 = kernel1(self.queue, (self.red_size * self.red_size,), (self.red_size,),
-                               self.buffers[0].data,
-                               self.buffers["max_min"].data,
-                               numpy.uint32(self.shape[0] * self.shape[1]))
-                k2 = kernel2(self.queue, (self.red_size,), (self.red_size,),
-                               self.buffers["max_min"].data,
-                               self.buffers["max"].data,
-                               self.buffers["min"].data)
+    def _input_buffer(self, dtype):
+        """
+        Select the buffer on the device receiving the input image
 
-                if self.profile:
-                    self.events.append(("max_min_stage1", k1))
-                    self.events.append(("max_min_stage2", k2))
+        :param dtype: data type of the image sent to the device
+        :return: buffers[0] for float images, buffers["raw"] when a conversion kernel is needed
+        """
+        if (dtype == numpy.float32) or (self.dtype == numpy.float64):
+            # A preprocessing kernel double_to_float exists, but is commented (RUNS ONLY ON GPU WITH FP64)
+            # TODO: benchmark this kernel vs the current pure CPU format conversion with numpy.float32
+            #       and uncomment it if it proves faster (dubious, because of data transfer bottleneck)
+            return self.buffers[0]
+        elif (self.RGB and self.dtype == numpy.uint8) or (self.dtype in self.converter):
+            return self.buffers["raw"]
+        else:
+            raise RuntimeError("invalid input format error (%s)" % (str(self.dtype)))
 
+    def _keypoints_on_device(self, buffer_):
+        """
+        Calculates the keypoints of the image already on the device
+
+        :param buffer_: buffer containing the image, as returned by _input_buffer
+        :return: vector of keypoint (1D numpy array)
+        """
+        total_size = 0
+        keypoints = []
+        descriptors = []
+        if (buffer_ is not self.buffers[0]) and ("reductions_raw" in self.programs):
+            # cast fused with the normalization
+            self._max_min("reductions_raw", buffer_)
+            program = self.programs["preprocess"].__getattr__(self.converter[self.dtype] + "_normalized")
+            evt = program(self.queue, self.procsize[0], self.wgsize[0],
+                          buffer_.data, self.buffers[0].data,
+                          self.buffers["min"].data,
+                          self.buffers["max"].data,
+                          self.buffers["255"].data,
+                          *self.scales[0])
+            if self.profile:
+                self.events.append(("convert + normalize", evt))
+        else:
+            if buffer_ is not self.buffers[0]:
+                if self.RGB and (self.dtype == numpy.uint8):
+                    evt = self.programs["preprocess"].rgb_to_float(self.queue, self.procsize[0], self.wgsize[0],
+                                                                   buffer_.data, self.buffers[0].data,
+                                                                   *self.scales[0])
+                    if self.profile:
+                        self.events.append(("RGB -> float", evt))
+                else:
+                    program = self.programs["preprocess"].__getattr__(self.converter[self.dtype])
+                    evt = program(self.queue, self.procsize[0], self.wgsize[0],
+                                  buffer_.data, self.buffers[0].data, *self.scales[0])
+                    if self.profile:
+                        self.events.append(("convert -> float", evt))
+            self._max_min("reductions", self.buffers[0])
             evt = self.programs["preprocess"].normalizes(self.queue, self.procsize[0], self.wgsize[0],
                                                          self.buffers[0].data,
                                                          self.buffers["min"].data,
@@ -531,44 +880,114 @@ class SiftPlan(object):
             if self.profile:
                 self.events.append(("normalize", evt))
 
-            curSigma = 1.0 if par.DoubleImSize else 0.5
-            octave = 0
-            if self._init_sigma > curSigma:
-                logger.debug("Bluring image to achieve std: %f", self._init_sigma)
-                sigma = math.sqrt(self._init_sigma ** 2 - curSigma ** 2)
-                self._gaussian_convolution(self.buffers[0], self.buffers[0], sigma, 0)
+        octave = 0
+        if self.init_blur is not None:
+            logger.debug("Bluring image to achieve std: %f", self._init_sigma)
+            self._gaussian_convolution(self.buffers[0], self.buffers[0], self.init_blur[0], 0)
 
-            for octave in range(self.octave_max):
-                kp, descriptor = self._one_octave(octave)
-                logger.info("in octave %i found %i kp" % (octave, kp.shape[0]))
+        for octave in range(self.octave_max):
+            kp, descriptor = self._one_octave(octave)
+            logger.info("in octave %i found %i kp", octave, kp.shape[0])
 
-                if len(kp):
-                    #sieve out coordinates with NaNs
-                    mask = numpy.where(numpy.logical_not(numpy.isnan(kp.sum(axis=-1))))
-                    keypoints.append(kp[mask])
-                    descriptors.append(descriptor[mask])
-                    total_size += len(mask[0])
+            if len(kp):
+                #sieve out coordinates with NaNs
+                mask = numpy.where(numpy.logical_not(numpy.isnan(kp.sum(axis=-1))))
+                keypoints.append(kp[mask])
+                descriptors.append(descriptor[mask])
+                total_size += len(mask[0])
 
-            ########################################################################
-            # Merge keypoints in central memory
-            ########################################################################
-            output = numpy.recarray(shape=(total_size,), dtype=self.dtype_kp)
-            last = 0
-            for ds, desc in zip(keypoints, descriptors):
-                l = ds.shape[0]
-                if l > 0:
-                    output[last:last + l].x = ds[:, 0]
-                    output[last:last + l].y = ds[:, 1]
-                    output[last:last + l].scale = ds[:, 2]
-                    output[last:last + l].angle = ds[:, 3]
-                    output[last:last + l].desc = desc
-                    last += l
-            logger.info("Execution time: %.3fms" % (1000 * (time.time() - t0)))
+        ########################################################################
+        # Merge keypoints in central memory
+        ########################################################################
+        output = numpy.recarray(shape=(total_size,), dtype=self.dtype_kp)
+        last = 0
+        for ds, desc in zip(keypoints, descriptors):
+            l = ds.shape[0]
+            if l > 0:
+                output[last:last + l].x = ds[:, 0]
+                output[last:last + l].y = ds[:, 1]
+                output[last:last + l].scale = ds[:, 2]
+                output[last:last + l].angle = ds[:, 3]
+                output[last:last + l].desc = desc
+                last += l
         return output
 
-    __call__ = keypoints
+    def _max_min(self, program_name, data):
+        """
+        Calculate the maximum and the minimum of the image into buffers["max"] and buffers["min"]
 
-    def _gaussian_convolution(self, input_data, output_data, sigma, octave=0):
+        :param program_name: name of the reduction program in self.programs, compiled for the type of data
+        :param data: pyopencl array with the image
+        """
+        # Min and max stay on the device: normalizes reads them from global memory,
+        # so no host synchronization is needed before it is enqueued.
+        program = self.programs[program_name]
+        # limits of the kernels actually launched, which depend on DTYPE
+        wg1 = self.kernels[program_name + ".max_min_global_stage1"]
+        wg2 = self.kernels[program_name + ".max_min_global_stage2"]
+        if min(wg1, wg2) < self.red_size:
+            #common bug on OSX when running on CPU
+            logger.info("Unable to use MinMax Reduction: stage1 wg: %s; stage2 wg: %s < max_work_group_size: %s, expected: %s",
+                        wg1, wg2, self.max_workgroup_size, self.red_size)
+            kernel = program.max_min_serial
+            k = kernel(self.queue, (1,), (1,),
+                           data.data,
+                           numpy.uint32(self.shape[0] * self.shape[1]),
+                           self.buffers["max"].data,
+                           self.buffers["min"].data)
+            if self.profile:
+                self.events.append(("max_min_serial", k))
+        else:
+            kernel1 = program.max_min_global_stage1
+            kernel2 = program.max_min_global_stage2
+            #logger.debug("self.red_size: %s", self.red_size)
+            k1 = kernel1(self.queue, (self.red_size * self.red_size,), (self.red_size,),
+                           data.data,
+                           self.buffers["max_min"].data,
+                           numpy.uint32(self.shape[0] * self.shape[1]))
+            k2 = kernel2(self.queue, (self.red_size,), (self.red_size,),
+                           self.buffers["max_min"].data,
+                           self.buffers["max"].data,
+                           self.buffers["min"].data)
+
+            if self.profile:
+                self.events.append(("max_min_stage1", k1))
+                self.events.append(("max_min_stage2", k2))
+
+    def _copy_input(self, image, buffer_):
+        """
+        Copy the input image to the device.
+
+        Numpy images with the shape of the pinned (page-locked) host buffer are
+        first copied (and casted if needed) into it, so that the transfer runs
+        at full speed without blocking the host. The event of the transfer is
+        kept in self._input_evt and waited for before host_view is written again.
+        On devices sharing the memory of the host, the buffer is mapped and
+        written directly, without any transfer.
+
+        :param image: numpy or pyopencl array with the input image
+        :param buffer_: pyopencl array on the device
+        """
+        if isinstance(image, pyopencl.array.Array):
+            evt = pyopencl.enqueue_copy(self.queue, buffer_.data, image.data)
+        elif self.unified_memory and (tuple(image.shape) == tuple(buffer_.shape)):
+            view, _ = pyopencl.enqueue_map_buffer(self.queue, buffer_.data, pyopencl.map_flags.WRITE,
+                                                  0, buffer_.shape, buffer_.dtype)
+            view[...] = image
+            evt = view.base.release(self.queue)
+            view = None
+        elif (self.host_view is not None) and (self.host_view.dtype == buffer_.dtype) and (self.host_view.shape == image.shape):
+            if self._input_evt is not None:
+                # the former frame may still be read from host_view
+                self._input_evt.wait()
+            self.host_view[...] = image
+            evt = self._input_evt = pyopencl.enqueue_copy(self.queue, buffer_.data, self.host_view, is_blocking=False)
+        else:
+            evt = pyopencl.enqueue_copy(self.queue, buffer_.data, numpy.ascontiguousarray(image, dtype=buffer_.dtype))
+        if self.profile:
+            self.events.append(("copy H->D", evt))
+
+    def _gaussian_convolution(self, input_data, output_data, sigma, octave=0, dog=None, shrunk=None):
         """
         Calculate the gaussian convolution with precalculated kernels.
 
@@ -576,19 +995,87 @@ class SiftPlan(object):
         :param output_data: pyopencl array with result
         :param sigma: width of the gaussian
         :param octave: related to the size on the input images
+        :param dog: if not None, index of the DoG (input - output) to calculate in the same pass
+        :param shrunk: if not None (needs dog), pyopencl array receiving output subsampled by 2
 
-        * Uses a temporary buffer
+        * Uses a temporary buffer (float16 if HALF_TMP, image2d if IMAGE_TMP)
         * Needs gaussian kernel to be available on device
 
         """
-        temp_data = self.buffers["tmp"]
+        if self.IMAGE_TMP:
+            temp_data = self.buffers["tmp_image"]
+        elif self.HALF_TMP:
+            temp_data = self.buffers["tmp_half"].data
+        else:
+            temp_data = self.buffers["tmp"].data
         gaussian = self.buffers["gaussian_%s" % sigma]
-        k1 = self.programs["convolution"].horizontal_convolution(self.queue, self.procsize[octave], self.wgsize[octave],
-                                                                 input_data.data, temp_data.data, gaussian.data, numpy.int32(gaussian.size),
-                                                                 *self.scales[octave])
-        k2 = self.programs["convolution"].vertical_convolution(self.queue, self.procsize[octave], self.wgsize[octave],
-                                                               temp_data.data, output_data.data, gaussian.data, numpy.int32(gaussian.size),
-                                                               *self.scales[octave])
+        ksize = numpy.int32(gaussian.size)
+        kernels = self.conv_kernels[gaussian.size]
+        width, height = self.scales[octave]
+        gaussian_data = gaussian.data
+        # Kernels specialized for ksize may accept smaller workgroups than the generic ones
+        limits = self.conv_workgroups[gaussian.size]
+        wg = self.wgsize[octave]
+        wg2d = self.wgsize_2d[octave]
+        if dog is None:
+            vertical_local = "vertical_convolution_local"
+        elif shrunk is not None:
+            vertical_local = "vertical_convolution_and_subtract_shrink_local"
+        else:
+            vertical_local = "vertical_convolution_and_subtract_local"
+        use_local = (self.local_convolution and
+                     wg[0] * wg[1] <= limits.get("horizontal_convolution_local", 0) and
+                     wg2d[0] * wg2d[1] <= limits.get(vertical_local, 0))
+        use_vec4 = (self.vec4_convolution and
+                    self.wgsize_vec4[octave][0] <= limits.get("horizontal_convolution_vec4", 0))
+        if use_local:
+            size_of_float = numpy.dtype(numpy.float32).itemsize
+            tile_h = pyopencl.LocalMemory(int(size_of_float * (wg[0] + ksize - 1) * wg[1]))
+            tile_v = pyopencl.LocalMemory(int(size_of_float * (wg2d[1] + ksize - 1) * wg2d[0]))
+            k1 = kernels["horizontal_convolution_local"](self.queue, self.procsize[octave], wg,
+                                                         input_data.data, temp_data, gaussian_data, ksize,
+                                                         tile_h, width, height)
+            if dog is None:
+                k2 = kernels["vertical_convolution_local"](self.queue, self.procsize_2d[octave], wg2d,
+                                                           temp_data, output_data.data, gaussian_data, ksize,
+                                                           tile_v, width, height)
+            elif shrunk is not None:
+                k2 = kernels["vertical_convolution_and_subtract_shrink_local"](self.queue, self.procsize_2d[octave], wg2d,
+                                                                               temp_data, input_data.data, output_data.data,
+                                                                               self.buffers["DoGs"].data, shrunk.data,
+                                                                               gaussian_data, ksize, numpy.int32(dog),
+                                                                               tile_v, width, height)
+            else:
+                k2 = kernels["vertical_convolution_and_subtract_local"](self.queue, self.procsize_2d[octave], wg2d,
+                                                                        temp_data, input_data.data, output_data.data,
+                                                                        self.buffers["DoGs"].data,
+                                                                        gaussian_data, ksize, numpy.int32(dog),
+                                                                        tile_v, width, height)
+        else:
+            if use_vec4:
+                k1 = kernels["horizontal_convolution_vec4"](self.queue, self.procsize_vec4[octave], self.wgsize_vec4[octave],
+                                                            input_data.data, temp_data, gaussian_data, ksize,
+                                                            width, height)
+            else:
+                k1 = kernels["horizontal_convolution"](self.queue, self.procsize[octave], wg,
+                                                       input_data.data, temp_data, gaussian_data, ksize,
+                                                       width, height)
+            if dog is None:
+                k2 = kernels["vertical_convolution"](self.queue, self.procsize[octave], wg,
+                                                     temp_data, output_data.data, gaussian_data, ksize,
+                                                     width, height)
+            elif shrunk is not None:
+                k2 = kernels["vertical_convolution_and_subtract_shrink"](self.queue, self.procsize[octave], wg,
+                                                                         temp_data, input_data.data, output_data.data,
+                                                                         self.buffers["DoGs"].data, shrunk.data,
+                                                                         gaussian_data, ksize, numpy.int32(dog),
+                                                                         width, height)
+            else:
+                k2 = kernels["vertical_convolution_and_subtract"](self.queue, self.procsize[octave], wg,
+                                                                  temp_data, input_data.data, output_data.data,
+                                                                  self.buffers["DoGs"].data,
+                                                                  gaussian_data, ksize, numpy.int32(dog),
+                                                                  width, height)
 
         if self.profile:
             self.events += [("Blur sigma %s octave %s" % (sigma, octave), k1), ("Blur sigma %s octave %s" % (sigma, octave), k2)]
@@ -599,30 +1086,27 @@ class SiftPlan(object):
 
         :param octave: number of the octave
         """
-        prevSigma = self._init_sigma
-        logger.info("Calculating octave %i" % octave)
+        logger.info("Calculating octave %i", octave)
         wgsize = (128,)  # (max(self.wgsize[octave]),) #TODO: optimize
         kpsize32 = numpy.int32(self.kpsize)
         self._reset_keypoints()
         octsize = numpy.int32(2 ** octave)
         last_start = numpy.int32(0)
-        for scale in range(par.Scales + 2):
-            sigma = prevSigma * math.sqrt(self.sigmaRatio ** 2 - 1.0)
-            logger.info("Octave %i scale %s blur with sigma %s" % (octave, scale, sigma))
+        # The base image of the next octave is subsampled from buffers[par.Scales] while it is calculated.
+        # buffers[0] is free at that point unless it is the input of this very blur.
+        fused_shrink = (octave < self.octave_max - 1) and (par.Scales > 1)
+        for scale, (sigma, _) in enumerate(self.blurs):
+            logger.info("Octave %i scale %s blur with sigma %s", octave, scale, sigma)
 
             ########################################################################
-            # Calculate gaussian blur and DoG
+            # Calculate gaussian blur and DoG (fused in the vertical pass)
             ########################################################################
 
-            self._gaussian_convolution(self.buffers[scale], self.buffers[scale + 1], sigma, octave)
-            prevSigma *= self.sigmaRatio
-            evt = self.programs["algebra"].combine(self.queue, self.procsize[octave], self.wgsize[octave],
-                                                   self.buffers[scale + 1].data, numpy.float32(-1.0),
-                                                   self.buffers[scale].data, numpy.float32(+1.0),
-                                                   self.buffers["DoGs"].data, numpy.int32(scale),
-                                                   *self.scales[octave])
-            if self.profile:
-                self.events.append(("DoG %s %s" % (octave, scale), evt))
+            if fused_shrink and (scale + 1 == par.Scales):
+                self._gaussian_convolution(self.buffers[scale], self.buffers[scale + 1], sigma, octave, dog=scale,
+                                           shrunk=self.buffers[0])
+            else:
+                self._gaussian_convolution(self.buffers[scale], self.buffers[scale + 1], sigma, octave, dog=scale)
         for scale in range(1, par.Scales + 1):
             evt = self.programs["image"].local_maxmin(self.queue, self.procsize[octave], self.wgsize[octave],
                                                       self.buffers["DoGs"].data,  # __global float* DOGS,
@@ -654,7 +1138,8 @@ class SiftPlan(object):
                                 ("interp_keypoint %s %s" % (octave, scale), evt)
                                 ]
 
-            newcnt = self._compact(last_start)
+            # interp_keypoint does not modify the counter: no need to read it back again
+            newcnt = self._compact(last_start, self.cnt[0])
             evt = self.programs["image"].compute_gradient_orientation(self.queue, self.procsize[octave], self.wgsize[octave],
                                                                       self.buffers[scale].data,  # __global float* igray,
                                                                       self.buffers["tmp"].data,  # __global float *grad,
@@ -728,15 +1213,13 @@ class SiftPlan(object):
                                     ("copy cnt D->H", evt_cp),
                                     ("descriptors %s %s" % (octave, scale), evt2)]
 
-            evt_cp = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
-            last_start = self.cnt[0]
-            if self.profile:
-                self.events.append(("copy cnt D->H", evt_cp))
+            # descriptor does not modify the counter, last read is still valid
+            last_start = numpy.int32(newcnt)
 
         ########################################################################
-        # Rescale all images to populate all octaves
+        # Rescale all images to populate all octaves (if not fused with the blur)
         ########################################################################
-        if octave < self.octave_max - 1:
+        if (octave < self.octave_max - 1) and not fused_shrink:
             evt = self.programs["preprocess"].shrink(self.queue, self.procsize[octave + 1], self.wgsize[octave + 1],
                                                      self.buffers[par.Scales].data,
                                                      self.buffers[0].data,
@@ -755,24 +1238,31 @@ class SiftPlan(object):
                                 ("copy D->H", evt2)]
         return results, descriptors
 
-    def _compact(self, start=numpy.int32(0)):
+    def _compact(self, start=numpy.int32(0), kp_counter=None):
         """
         Compact the vector of keypoints starting from start
 
         :param start: start compacting at this adress. Before just copy
         :type  start: numpy.int32
+        :param kp_counter: value of the keypoint counter on the device, if already known on the host.
+                           If None, it is read back from the device.
         """
         wgsize = self.max_workgroup_size,  # (max(self.wgsize[0]),) #TODO: optimize
 #         kpsize32 = numpy.int32(self.kpsize)
-        cp0_evt = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
-        kp_counter = self.cnt[0]
+        if kp_counter is None:
+            cp0_evt = pyopencl.enqueue_copy(self.queue, self.cnt, self.buffers["cnt"].data)
+            kp_counter = self.cnt[0]
+            if self.profile:
+                self.events.append(("copy cnt D->H", cp0_evt))
+        kp_counter = numpy.int32(kp_counter)
         procsize = calc_size((self.kpsize,), wgsize)
 
         if kp_counter > 0.9 * self.kpsize:
-            logger.warning("Keypoint counter overflow risk: counted %s / %s" % (kp_counter, self.kpsize))
-        logger.info("Compact %s -> %s / %s" % (start, kp_counter, self.kpsize))
-        self.cnt[0] = start
-        cp1_evt = pyopencl.enqueue_copy(self.queue, self.buffers["cnt"].data, self.cnt)
+            logger.warning("Keypoint counter overflow risk: counted %s / %s", kp_counter, self.kpsize)
+        logger.info("Compact %s -> %s / %s", start, kp_counter, self.kpsize)
+        # reset the counter on the device, without synchronizing with the host
+        cp1_evt = self.programs["memset"].memset_int(self.queue, (1,), (1,), self.buffers["cnt"].data,
+                                                     numpy.int32(start), numpy.int32(1))
         evt = self.programs["algebra"].compact(self.queue, procsize, wgsize,
                                                self.buffers["Kp_1"].data,  # __global keypoint* keypoints,
                                                self.buffers["Kp_2"].data,  # __global keypoint* output,
@@ -786,8 +1276,7 @@ class SiftPlan(object):
 #        self.buffers["Kp_2"].fill(-1, self.queue)
         mem_evt = self.programs["memset"].memset_float(self.queue, calc_size((4 * self.kpsize,), wgsize), wgsize, self.buffers["Kp_2"].data, numpy.float32(-1), numpy.int32(4 * self.kpsize))
         if self.profile:
-            self.events += [("copy cnt D->H", cp0_evt),
-                            ("copy cnt H->D", cp1_evt),
+            self.events += [("memset cnt", cp1_evt),
                             ("compact", evt),
                             ("copy cnt D->H", cp2_evt),
                             ("memset 2", mem_evt)
@@ -76,6 +76,21 @@ def kernel_size(sigma, odd=False, cutoff=4):
     return size
 
 
+def nextpower(size):
+    """
+    Calculate the next power of two, greater or equal to size
+
+    Exact integer calculation, unlike 2 ** ceil(log(size, 2)) which can be
+    wrong by one power for sizes that are already a power of two.
+
+    :param size: positive number (int or float)
+    """
+    size = int(ceil(size))
+    if size <= 1:
+        return 1
+    return 1 << (size - 1).bit_length()
+
+
 def sizeof(shape, dtype="uint8"):
     """
     Calculate the number of bytes needed to allocate for a given structure
@@ -46,7 +46,7 @@ import pyopencl, pyopencl.array
 import scipy, scipy.misc, scipy.ndimage
 import sys
 import unittest
-from utilstest import UtilsTest, getLogger, ctx
+from utilstest import UtilsTest, getLogger, ctx, build_program
 import sift_pyocl as sift
 from sift_pyocl.utils import calc_size
 logger = getLogger(__file__)
@@ -92,8 +92,7 @@ class test_algebra(unittest.TestCase):
     def setUp(self):
 
         kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "algebra.cl")
-        kernel_src = open(kernel_path).read()
-        self.program = pyopencl.Program(ctx, kernel_src).build()
+        self.program = build_program(kernel_path)
         self.wg = (32, 4)
 
 
@@ -52,6 +52,7 @@ from test_algebra import test_suite_algebra
 from test_image import test_suite_image
 from test_keypoints import test_suite_keypoints
 from test_matching import test_suite_matching
+from test_plan import test_suite_plan
 
 def test_suite_all():
     testSuite = unittest.TestSuite()
@@ -63,6 +64,7 @@ def test_suite_all():
     testSuite.addTest(test_suite_image())
     testSuite.addTest(test_suite_keypoints())
     testSuite.addTest(test_suite_matching())
+    testSuite.addTest(test_suite_plan())
     return testSuite
 
 if __name__ == '__main__':
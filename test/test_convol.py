@@ -46,7 +46,7 @@ import pyopencl, pyopencl.array
 import scipy, scipy.misc, scipy.ndimage
 import sys
 import unittest
-from utilstest import UtilsTest, getLogger, ctx
+from utilstest import UtilsTest, getLogger, ctx, build_program
 import sift_pyocl as sift
 from sift_pyocl.utils import calc_size
 logger = getLogger(__file__)
@@ -78,11 +78,10 @@ class test_convol(unittest.TestCase):
         self.gpu_tmp = pyopencl.array.empty(queue, self.input.shape, dtype=numpy.float32, order="C")
         self.gpu_out = pyopencl.array.empty(queue, self.input.shape, dtype=numpy.float32, order="C")
         kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "convolution.cl")
-        kernel_src = open(kernel_path).read()
 #        compile_options = "-D NIMAGE=%i" % self.input.size
 #        logger.info("Compiling file %s with options %s" % (kernel_path, compile_options))
 #        self.program = pyopencl.Program(ctx, kernel_src).build(options=compile_options)
-        self.program = pyopencl.Program(ctx, kernel_src).build()
+        self.program = build_program(kernel_path)
         self.IMAGE_W = numpy.int32(self.input.shape[-1])
         self.IMAGE_H = numpy.int32(self.input.shape[0])
         self.wg = (256, 2)
@@ -93,6 +92,35 @@ class test_convol(unittest.TestCase):
 #        self.gpudata.release()
         self.program = None
 
+    def test_convol_vec4(self):
+        """
+        tests the horizontal convolution kernel reading float4, 4 pixels per work-item
+        """
+        wg = (64, 2)
+        shape = calc_size(((self.input.shape[1] + 3) // 4, self.input.shape[0]), wg)
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution_vec4(queue, shape, wg,
+                                self.gpu_in.data, self.gpu_out.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            t1 = time.time()
+            ref = scipy.ndimage.filters.convolve1d(self.input, gaussian, axis= -1, mode="reflect")
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution (float4) took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start)))
+
     def test_convol_hor(self):
         """
         tests the convolution kernel
@@ -215,11 +243,382 @@ class test_convol(unittest.TestCase):
                 fig.show()
                 raw_input("enter")
 
+    def test_convol_dog(self):
+        """
+        tests the vertical convolution kernel fused with the DoG calculation
+        """
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            gpu_dogs = pyopencl.array.empty(queue, (2,) + self.input.shape, dtype=numpy.float32, order="C")
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            k2 = self.program.vertical_convolution_and_subtract(queue, self.shape, self.wg,
+                                self.gpu_tmp.data, self.gpu_in.data, self.gpu_out.data, gpu_dogs.data,
+                                gpu_filter.data, numpy.int32(ksize), numpy.int32(1), self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            res_dog = gpu_dogs.get()[1]
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            ref_dog = self.input - ref
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            delta_dog = abs(ref_dog - res_dog).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_dog < 50, "sigma= %s delta_dog=%s" % (sigma, delta_dog))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_dog < 1e-4, "sigma= %s delta_dog=%s" % (sigma, delta_dog))
+            logger.info("sigma= %s delta=%s delta_dog=%s" % (sigma, delta, delta_dog))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution + DoG took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                 1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_shrink(self):
+        """
+        tests the vertical convolution kernel fused with the DoG calculation and the shrink
+        """
+        small_shape = (self.input.shape[0] // 2, self.input.shape[1] // 2)
+        gpu_small = pyopencl.array.empty(queue, small_shape, dtype=numpy.float32, order="C")
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            gpu_dogs = pyopencl.array.empty(queue, (2,) + self.input.shape, dtype=numpy.float32, order="C")
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            k2 = self.program.vertical_convolution_and_subtract_shrink(queue, self.shape, self.wg,
+                                self.gpu_tmp.data, self.gpu_in.data, self.gpu_out.data, gpu_dogs.data, gpu_small.data,
+                                gpu_filter.data, numpy.int32(ksize), numpy.int32(1), self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            res_small = gpu_small.get()
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            ref_small = ref[:2 * small_shape[0]:2, :2 * small_shape[1]:2]
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            delta_small = abs(ref_small - res_small).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_small < 50, "sigma= %s delta_small=%s" % (sigma, delta_small))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_small < 1e-4, "sigma= %s delta_small=%s" % (sigma, delta_small))
+            logger.info("sigma= %s delta=%s delta_small=%s" % (sigma, delta, delta_small))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution + DoG + shrink took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                          1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_half(self):
+        """
+        tests the convolution kernel with the temporary image stored in half precision
+        """
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "convolution.cl")
+        program = build_program(kernel_path, "-D HALF_TMP")
+        gpu_tmp = pyopencl.array.empty(queue, self.input.shape, dtype=numpy.float16, order="C")
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            t0 = time.time()
+            k1 = program.horizontal_convolution(queue, self.shape, self.wg,
+                                self.gpu_in.data, gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            k2 = program.vertical_convolution(queue, self.shape, self.wg,
+                                gpu_tmp.data, self.gpu_out.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+            else:
+                # half precision: 11 bits of mantissa on values up to 255
+                self.assert_(delta < 0.25, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                          1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_image(self):
+        """
+        tests the convolution kernel with the temporary image stored in an image2d
+        """
+        if not ctx.devices[0].image_support:
+            logger.warning("Device %s has no image support: skipping test" % ctx.devices[0].name)
+            return
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "convolution.cl")
+        program = build_program(kernel_path, "-D IMAGE_TMP")
+        img_tmp = pyopencl.Image(ctx, pyopencl.mem_flags.READ_WRITE,
+                                 pyopencl.ImageFormat(pyopencl.channel_order.R, pyopencl.channel_type.FLOAT),
+                                 shape=(self.input.shape[1], self.input.shape[0]))
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            t0 = time.time()
+            k1 = program.horizontal_convolution(queue, self.shape, self.wg,
+                                self.gpu_in.data, img_tmp, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            k2 = program.vertical_convolution(queue, self.shape, self.wg,
+                                img_tmp, self.gpu_out.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                          1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_local(self):
+        """
+        tests the convolution kernels using tiles in local memory
+        """
+        wg2d = (16, 16)
+        shape2d = calc_size((self.input.shape[1], self.input.shape[0]), wg2d)
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            tile_h = pyopencl.LocalMemory(4 * (self.wg[0] + ksize - 1) * self.wg[1])
+            tile_v = pyopencl.LocalMemory(4 * (wg2d[1] + ksize - 1) * wg2d[0])
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution_local(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), tile_h, self.IMAGE_W, self.IMAGE_H)
+            k2 = self.program.vertical_convolution_local(queue, shape2d, wg2d,
+                                self.gpu_tmp.data, self.gpu_out.data, gpu_filter.data, numpy.int32(ksize), tile_v, self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                          1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_dog_local(self):
+        """
+        tests the vertical convolution kernel using tiles in local memory, fused with the DoG calculation
+        """
+        wg2d = (16, 16)
+        shape2d = calc_size((self.input.shape[1], self.input.shape[0]), wg2d)
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            gpu_dogs = pyopencl.array.empty(queue, (2,) + self.input.shape, dtype=numpy.float32, order="C")
+            tile_h = pyopencl.LocalMemory(4 * (self.wg[0] + ksize - 1) * self.wg[1])
+            tile_v = pyopencl.LocalMemory(4 * (wg2d[1] + ksize - 1) * wg2d[0])
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution_local(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), tile_h, self.IMAGE_W, self.IMAGE_H)
+            k2 = self.program.vertical_convolution_and_subtract_local(queue, shape2d, wg2d,
+                                self.gpu_tmp.data, self.gpu_in.data, self.gpu_out.data, gpu_dogs.data,
+                                gpu_filter.data, numpy.int32(ksize), numpy.int32(1), tile_v, self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            res_dog = gpu_dogs.get()[1]
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            ref_dog = self.input - ref
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            delta_dog = abs(ref_dog - res_dog).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_dog < 50, "sigma= %s delta_dog=%s" % (sigma, delta_dog))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_dog < 1e-4, "sigma= %s delta_dog=%s" % (sigma, delta_dog))
+            logger.info("sigma= %s delta=%s delta_dog=%s" % (sigma, delta, delta_dog))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution + DoG took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                 1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_shrink_local(self):
+        """
+        tests the vertical convolution kernel using tiles in local memory, fused with the DoG calculation and the shrink
+        """
+        wg2d = (16, 16)
+        shape2d = calc_size((self.input.shape[1], self.input.shape[0]), wg2d)
+        small_shape = (self.input.shape[0] // 2, self.input.shape[1] // 2)
+        gpu_small = pyopencl.array.empty(queue, small_shape, dtype=numpy.float32, order="C")
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            gpu_dogs = pyopencl.array.empty(queue, (2,) + self.input.shape, dtype=numpy.float32, order="C")
+            tile_h = pyopencl.LocalMemory(4 * (self.wg[0] + ksize - 1) * self.wg[1])
+            tile_v = pyopencl.LocalMemory(4 * (wg2d[1] + ksize - 1) * wg2d[0])
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution_local(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), tile_h, self.IMAGE_W, self.IMAGE_H)
+            k2 = self.program.vertical_convolution_and_subtract_shrink_local(queue, shape2d, wg2d,
+                                self.gpu_tmp.data, self.gpu_in.data, self.gpu_out.data, gpu_dogs.data, gpu_small.data,
+                                gpu_filter.data, numpy.int32(ksize), numpy.int32(1), tile_v, self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            res_dog = gpu_dogs.get()[1]
+            res_small = gpu_small.get()
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            ref_dog = self.input - ref
+            ref_small = ref[:2 * small_shape[0]:2, :2 * small_shape[1]:2]
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            delta_dog = abs(ref_dog - res_dog).max()
+            delta_small = abs(ref_small - res_small).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_dog < 50, "sigma= %s delta_dog=%s" % (sigma, delta_dog))
+                self.assert_(delta_small < 50, "sigma= %s delta_small=%s" % (sigma, delta_small))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+                self.assert_(delta_dog < 1e-4, "sigma= %s delta_dog=%s" % (sigma, delta_dog))
+                self.assert_(delta_small < 1e-4, "sigma= %s delta_small=%s" % (sigma, delta_small))
+            logger.info("sigma= %s delta=%s delta_dog=%s delta_small=%s" % (sigma, delta, delta_dog, delta_small))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution + DoG + shrink took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                          1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_ksize(self):
+        """
+        tests the convolution kernel with the filter size fixed at compile time
+        """
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "convolution.cl")
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            program = build_program(kernel_path, "-D KSIZE=%i" % ksize)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            t0 = time.time()
+            k1 = program.horizontal_convolution(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            k2 = program.vertical_convolution(queue, self.shape, self.wg,
+                                self.gpu_tmp.data, self.gpu_out.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            res = self.gpu_out.get()
+            t1 = time.time()
+            ref = my_blur(self.input, gaussian)
+            t2 = time.time()
+            delta = abs(ref - res).max()
+            if ksize % 2 == 0:  #we have a problem with even kernels !!!
+                self.assert_(delta < 50, "sigma= %s delta=%s" % (sigma, delta))
+            else:
+                self.assert_(delta < 1e-4, "sigma= %s delta=%s" % (sigma, delta))
+            logger.info("sigma= %s delta=%s" % (sigma, delta))
+            if PROFILE:
+                logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+                logger.info("Horizontal convolution took %.3fms and vertical convolution took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                          1e-6 * (k2.profile.end - k2.profile.start)))
+
+    def test_convol_batch(self):
+        """
+        tests the convolution kernels fused with the DoG and the shrink on a stack of frames,
+        launched once with the frame as third dimension, against one launch per frame
+        """
+        frames = numpy.ascontiguousarray([self.input, self.input[::-1, ::-1], 255.0 - self.input], dtype=numpy.float32)
+        nframes = frames.shape[0]
+        small_shape = (self.input.shape[0] // 2, self.input.shape[1] // 2)
+        shape3d = tuple(self.shape) + (nframes,)
+        wg3d = self.wg + (1,)
+        gpu_frames = pyopencl.array.to_device(queue, frames)
+        gpu_tmp = pyopencl.array.empty(queue, frames.shape, dtype=numpy.float32, order="C")
+        gpu_out = pyopencl.array.empty(queue, frames.shape, dtype=numpy.float32, order="C")
+        gpu_small = pyopencl.array.empty(queue, (nframes,) + small_shape, dtype=numpy.float32, order="C")
+        gpu_dogs = pyopencl.array.empty(queue, (2, nframes) + self.input.shape, dtype=numpy.float32, order="C")
+        gpu_small1 = pyopencl.array.empty(queue, small_shape, dtype=numpy.float32, order="C")
+        gpu_dogs1 = pyopencl.array.empty(queue, (2,) + self.input.shape, dtype=numpy.float32, order="C")
+        for sigma in [2, 15 / 8.]:
+            ksize = int(8 * sigma + 1)
+            x = numpy.arange(ksize) - (ksize - 1.0) / 2.0
+            gaussian = numpy.exp(-(x / sigma) ** 2 / 2.0).astype(numpy.float32)
+            gaussian /= gaussian.sum(dtype=numpy.float32)
+            gpu_filter = pyopencl.array.to_device(queue, gaussian)
+            t0 = time.time()
+            k1 = self.program.horizontal_convolution(queue, shape3d, wg3d,
+                                gpu_frames.data, gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+            k2 = self.program.vertical_convolution_and_subtract_shrink(queue, shape3d, wg3d,
+                                gpu_tmp.data, gpu_frames.data, gpu_out.data, gpu_dogs.data, gpu_small.data,
+                                gpu_filter.data, numpy.int32(ksize), numpy.int32(1), self.IMAGE_W, self.IMAGE_H)
+            res = gpu_out.get()
+            res_dog = gpu_dogs.get()[1]
+            res_small = gpu_small.get()
+            t1 = time.time()
+            t_single = 0.0
+            for frame in range(nframes):
+                self.gpu_in.set(frames[frame], queue)
+                t2 = time.time()
+                self.program.horizontal_convolution(queue, self.shape, self.wg,
+                                self.gpu_in.data, self.gpu_tmp.data, gpu_filter.data, numpy.int32(ksize), self.IMAGE_W, self.IMAGE_H)
+                self.program.vertical_convolution_and_subtract_shrink(queue, self.shape, self.wg,
+                                self.gpu_tmp.data, self.gpu_in.data, self.gpu_out.data, gpu_dogs1.data, gpu_small1.data,
+                                gpu_filter.data, numpy.int32(ksize), numpy.int32(1), self.IMAGE_W, self.IMAGE_H)
+                ref = self.gpu_out.get()
+                ref_dog = gpu_dogs1.get()[1]
+                ref_small = gpu_small1.get()
+                t_single += time.time() - t2
+                delta = abs(ref - res[frame]).max()
+                delta_dog = abs(ref_dog - res_dog[frame]).max()
+                delta_small = abs(ref_small - res_small[frame]).max()
+                self.assert_(delta < 1e-6, "sigma= %s frame=%s delta=%s" % (sigma, frame, delta))
+                self.assert_(delta_dog < 1e-6, "sigma= %s frame=%s delta_dog=%s" % (sigma, frame, delta_dog))
+                self.assert_(delta_small < 1e-6, "sigma= %s frame=%s delta_small=%s" % (sigma, frame, delta_small))
+                logger.info("sigma= %s frame=%s delta=%s delta_dog=%s delta_small=%s" % (sigma, frame, delta, delta_dog, delta_small))
+            if PROFILE:
+                logger.info("Execution time for %i frames: stacked %.3fms, one by one: %.3fms." % (nframes, 1000.0 * (t1 - t0), 1000.0 * t_single))
+                logger.info("Stacked horizontal convolution took %.3fms and vertical convolution + DoG + shrink took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start),
+                                                                                                                  1e-6 * (k2.profile.end - k2.profile.start)))
+
 def test_suite_convol():
     testSuite = unittest.TestSuite()
     testSuite.addTest(test_convol("test_convol"))
+    testSuite.addTest(test_convol("test_convol_dog"))
+    testSuite.addTest(test_convol("test_convol_shrink"))
+    testSuite.addTest(test_convol("test_convol_half"))
+    testSuite.addTest(test_convol("test_convol_image"))
+    testSuite.addTest(test_convol("test_convol_local"))
+    testSuite.addTest(test_convol("test_convol_dog_local"))
+    testSuite.addTest(test_convol("test_convol_shrink_local"))
+    testSuite.addTest(test_convol("test_convol_ksize"))
     testSuite.addTest(test_convol("test_convol_hor"))
+    testSuite.addTest(test_convol("test_convol_vec4"))
     testSuite.addTest(test_convol("test_convol_vert"))
+    testSuite.addTest(test_convol("test_convol_batch"))
     return testSuite
 
 if __name__ == '__main__':
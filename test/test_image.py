@@ -42,11 +42,11 @@ OTHER DEALINGS IN THE SOFTWARE.
 
 import time, os, logging
 import numpy
-import pyopencl, pyopencl.array
+import pyopencl, pyopencl.array, pyopencl.tools
 import scipy, scipy.misc, scipy.ndimage, pylab
 import sys
 import unittest
-from utilstest import UtilsTest, getLogger, ctx
+from utilstest import UtilsTest, getLogger, ctx, build_program
 from test_image_functions import * #for Python implementation of tested functions
 from test_image_setup import *
 import sift_pyocl as sift
@@ -59,6 +59,8 @@ if logger.getEffectiveLevel() <= logging.INFO:
 else:
     PROFILE = False
     queue = pyopencl.CommandQueue(ctx)
+#device buffers of the tests are recycled instead of being allocated for each test
+mempool = pyopencl.tools.MemoryPool(pyopencl.tools.ImmediateAllocator(queue))
 
 SHOW_FIGURES = False
 PRINT_KEYPOINTS = False
@@ -73,18 +75,38 @@ For Python implementation of tested functions, see "test_image_functions.py"
 
 
 class test_image(unittest.TestCase):
-    def setUp(self):
-
+    @classmethod
+    def setUpClass(cls):
+        """
+        The program and the pyramid of blurs/DoGs are the same for all tests: build them only once
+        """
         kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "image.cl")
-        kernel_src = open(kernel_path).read()
-        self.program = pyopencl.Program(ctx, kernel_src).build()
-        self.wg = (8, 1)
-
+        cls.program = build_program(kernel_path)
+        cls.maxmin = local_maxmin_setup()
+        #everything the kernels read is sent once to the device
+        cls.blur = numpy.ascontiguousarray(cls.maxmin[10][1])
+        cls.gpu_blur = pyopencl.array.to_device(queue, cls.blur)
+        cls.gpu_dogs = pyopencl.array.to_device(queue, cls.maxmin[9])
+        #keypoints vector and counter, reset by each test instead of being allocated again
+        nb_keypoints = cls.maxmin[6]
+        cls.gpu_keypoints = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
+        cls.counter = pyopencl.array.empty(queue, (1,), dtype=numpy.int32, order="C")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.program = None
+        cls.maxmin = None
+        cls.blur = None
+        cls.gpu_blur = None
+        cls.gpu_dogs = None
+        cls.gpu_keypoints = None
+        cls.counter = None
 
+    def setUp(self):
+        self.wg = (8, 1)
 
     def tearDown(self):
         self.mat = None
-        self.program = None
 
 
 
@@ -93,21 +115,23 @@ class test_image(unittest.TestCase):
         tests the gradient kernel (norm and orientation)
         """
         
-        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, scale, nb_keypoints, width, height, DOGS, g = local_maxmin_setup()
-        self.mat = numpy.ascontiguousarray(g[1])
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, scale, nb_keypoints, width, height, DOGS, g = self.maxmin
+        self.mat = self.blur
         self.height, self.width = numpy.int32(self.mat.shape)
-        self.gpu_mat = pyopencl.array.to_device(queue, self.mat)
-        self.gpu_grad = pyopencl.array.empty(queue, self.mat.shape, dtype=numpy.float32, order="C")
-        self.gpu_ori = pyopencl.array.empty(queue, self.mat.shape, dtype=numpy.float32, order="C")
+        self.gpu_grad = pyopencl.array.empty(queue, self.mat.shape, dtype=numpy.float32, order="C", allocator=mempool)
+        self.gpu_ori = pyopencl.array.empty(queue, self.mat.shape, dtype=numpy.float32, order="C", allocator=mempool)
         self.shape = calc_size((self.width, self.height), self.wg)
 
         t0 = time.time()
-        k1 = self.program.compute_gradient_orientation(queue, self.shape, self.wg, self.gpu_mat.data, self.gpu_grad.data, self.gpu_ori.data, self.width, self.height)
-        res_norm = self.gpu_grad.get()
-        res_ori = self.gpu_ori.get()
+        k1 = self.program.compute_gradient_orientation(queue, self.shape, self.wg, self.gpu_blur.data, self.gpu_grad.data, self.gpu_ori.data, self.width, self.height)
+        queue.flush() #submit the kernel to the device now, not at the next blocking call
         t1 = time.time()
+        #the reference is computed while the kernel runs
         ref_norm, ref_ori = my_gradient(self.mat)
         t2 = time.time()
+        res_norm = self.gpu_grad.get()
+        res_ori = self.gpu_ori.get()
+        t3 = time.time()
         delta_norm = abs(ref_norm - res_norm).max()
         delta_ori = abs(ref_ori - res_ori).max()
         if (PRINT_KEYPOINTS):
@@ -131,7 +155,7 @@ class test_image(unittest.TestCase):
         logger.info("delta_ori=%s" % delta_ori)
 
         if PROFILE:
-            logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+            logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0 + t3 - t2)))
             logger.info("Gradient computation took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start)))
 
 
@@ -143,12 +167,12 @@ class test_image(unittest.TestCase):
         tests the local maximum/minimum detection kernel
         """
         #local_maxmin_setup :
-        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = local_maxmin_setup()
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = self.maxmin
         self.s = numpy.int32(s) #1, 2, 3 ... not 4 nor 0.
-        self.gpu_dogs = pyopencl.array.to_device(queue, DOGS)
-        self.output = pyopencl.array.empty(queue, (nb_keypoints, 4), dtype=numpy.float32, order="C")
-        self.output.fill(-1.0, queue) #memset for invalid keypoints
-        self.counter = pyopencl.array.zeros(queue, (1,), dtype=numpy.int32, order="C")
+        self.output = self.gpu_keypoints
+        #both are only enqueued: the kernel waits for them on the in-order queue
+        self.output.fill(numpy.float32(-1.0), queue) #memset for invalid keypoints: the kernel only writes the ones it finds
+        self.counter.fill(numpy.int32(0), queue)
         nb_keypoints = numpy.int32(nb_keypoints)
         self.shape = calc_size((DOGS.shape[1], DOGS.shape[0] * DOGS.shape[2]), self.wg) #it's a 3D vector !!
 
@@ -157,28 +181,32 @@ class test_image(unittest.TestCase):
         	self.gpu_dogs.data, self.output.data,
        		border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
        		self.counter.data, nb_keypoints, self.s, width, height)
-
-        res = self.output.get()
-        self.keypoints1 = self.output #for further use
-        self.actual_nb_keypoints = self.counter.get()[0] #for further use
-
+        queue.flush() #submit the kernel to the device now, not at the next blocking call
         t1 = time.time()
+        #the reference is computed while the kernel runs
         ref, actual_nb_keypoints2 = my_local_maxmin(DOGS, peakthresh, border_dist, octsize,
         	EdgeThresh0, EdgeThresh, nb_keypoints, self.s, width, height)
         t2 = time.time()
 
+        res = self.output.get()
+        self.actual_nb_keypoints = self.counter.get()[0]
+        t3 = time.time()
+        if njit is not None or USE_MP:
+            #the scalar version is only fast enough when compiled, or split between processes
+            scalar_maxmin = my_local_maxmin_loop if njit is not None else my_local_maxmin_parallel
+            ref_loop, cnt_loop = scalar_maxmin(DOGS, peakthresh, border_dist, octsize,
+                EdgeThresh0, EdgeThresh, nb_keypoints, self.s, width, height)
+            self.assert_(cnt_loop == actual_nb_keypoints2, "vectorized: %s keypoints, loop: %s" % (actual_nb_keypoints2, cnt_loop))
+            self.assert_(abs(ref_loop - ref).max() == 0, "vectorized and loop references differ")
+
         #we have to sort the arrays, for peaks orders is unknown for GPU
-        res_peaks = res[(res[:, 0].argsort(axis=0)), 0]
-        ref_peaks = ref[(ref[:, 0].argsort(axis=0)), 0]
-        res_r = res[(res[:, 1].argsort(axis=0)), 1]
-        ref_r = ref[(ref[:, 1].argsort(axis=0)), 1]
-        res_c = res[(res[:, 2].argsort(axis=0)), 2]
-        ref_c = ref[(ref[:, 2].argsort(axis=0)), 2]
-        #res_s = res[(res[:,3].argsort(axis=0)),3]
-        #ref_s = ref[(ref[:,3].argsort(axis=0)),3]
-        delta_peaks = abs(ref_peaks - res_peaks).max()
-        delta_r = abs(ref_r - res_r).max()
-        delta_c = abs(ref_c - res_c).max()
+        #only valid keypoints are sorted, once, on their (c, r) position
+        res_valid = res[res[:, 1] != -1]
+        ref_valid = ref[ref[:, 1] != -1]
+        self.assert_(res_valid.shape == ref_valid.shape, "GPU: %s keypoints, CPU: %s" % (res_valid.shape[0], ref_valid.shape[0]))
+        res_valid = res_valid[numpy.lexsort((res_valid[:, 1], res_valid[:, 2]))]
+        ref_valid = ref_valid[numpy.lexsort((ref_valid[:, 1], ref_valid[:, 2]))]
+        delta_peaks, delta_r, delta_c = abs(ref_valid[:, :3] - res_valid[:, :3]).max(axis=0) if ref_valid.size else (0, 0, 0)
 
         if (PRINT_KEYPOINTS):
             print("keypoints after 2 steps of refinement: (s= %s, octsize=%s) %s" % (self.s, octsize, self.actual_nb_keypoints))
@@ -195,44 +223,95 @@ class test_image(unittest.TestCase):
 
 
         if PROFILE:
-            logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+            logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0 + t3 - t2)))
             logger.info("Local extrema search took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start)))
 
 
 
 
 
+    def test_local_maxmin_batch(self):
+        """
+        tests the local maximum/minimum detection kernel on a stack of frames, launched once
+        with the frame as third dimension, against one launch per frame
+        """
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = self.maxmin
+        s = numpy.int32(s)
+        nb_keypoints = numpy.int32(nb_keypoints)
+        frames = [DOGS, -DOGS, DOGS[:, ::-1, ::-1]] #minima become maxima and the image is mirrored
+        nframes = len(frames)
+        #DoG s of frame z is at s * nframes + z, as written by the stacked convolution kernels
+        stack = numpy.ascontiguousarray(numpy.array(frames, dtype=numpy.float32).transpose(1, 0, 2, 3))
+        gpu_stack = pyopencl.array.to_device(queue, stack)
+        output = pyopencl.array.empty(queue, (nframes * nb_keypoints, 4), dtype=numpy.float32, order="C")
+        counters = pyopencl.array.empty(queue, (nframes,), dtype=numpy.int32, order="C")
+        output.fill(numpy.float32(-1.0), queue)
+        counters.fill(numpy.int32(0), queue)
+        shape = calc_size((width, height), self.wg)
+
+        t0 = time.time()
+        k1 = self.program.local_maxmin(queue, tuple(shape) + (nframes,), self.wg + (1,),
+            gpu_stack.data, output.data,
+            border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+            counters.data, nb_keypoints, s, width, height)
+        res = output.get().reshape(nframes, nb_keypoints, 4)
+        res_cnt = counters.get()
+        t1 = time.time()
+        for frame in range(nframes):
+            gpu_dogs = pyopencl.array.to_device(queue, numpy.ascontiguousarray(frames[frame], dtype=numpy.float32))
+            self.gpu_keypoints.fill(numpy.float32(-1.0), queue)
+            self.counter.fill(numpy.int32(0), queue)
+            self.program.local_maxmin(queue, shape, self.wg,
+                gpu_dogs.data, self.gpu_keypoints.data,
+                border_dist, peakthresh, octsize, EdgeThresh0, EdgeThresh,
+                self.counter.data, nb_keypoints, s, width, height)
+            ref = self.gpu_keypoints.get()
+            ref_cnt = self.counter.get()[0]
+            self.assert_(res_cnt[frame] == ref_cnt, "frame %s: stacked %s keypoints, single %s" % (frame, res_cnt[frame], ref_cnt))
+            #the order of the keypoints is unknown: sort the valid ones on their (c, r) position
+            res_valid = res[frame][res[frame][:, 1] != -1]
+            ref_valid = ref[ref[:, 1] != -1]
+            self.assert_(res_valid.shape == ref_valid.shape, "frame %s: stacked %s keypoints, single %s" % (frame, res_valid.shape[0], ref_valid.shape[0]))
+            res_valid = res_valid[numpy.lexsort((res_valid[:, 1], res_valid[:, 2]))]
+            ref_valid = ref_valid[numpy.lexsort((ref_valid[:, 1], ref_valid[:, 2]))]
+            delta = abs(ref_valid - res_valid).max() if ref_valid.size else 0
+            self.assert_(delta == 0, "frame %s: delta=%s" % (frame, delta))
+            logger.info("frame %s: %s keypoints, delta=%s" % (frame, ref_cnt, delta))
+
+        if PROFILE:
+            logger.info("Stacked local extrema search of %i frames took %.3fms (%.3fms with transfers)" % (nframes, 1e-6 * (k1.profile.end - k1.profile.start), 1000.0 * (t1 - t0)))
+
     def test_interpolation(self):
         """
         tests the keypoints interpolation kernel
-        Requires the following: "self.keypoints1", "self.actual_nb_keypoints", 	"self.gpu_dog_prev", self.gpu_dog", 			"self.gpu_dog_next", "self.s", "self.width", "self.height", "self.peakthresh"
+        Keypoints come from interpolation_setup, the DoGs from setUpClass
         """
 
         #interpolation_setup :
-        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, nb_keypoints, actual_nb_keypoints, width, height, DOGS, s, keypoints_prev, blur = interpolation_setup()
+        border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, nb_keypoints, actual_nb_keypoints, width, height, DOGS, s, keypoints_prev, blur = interpolation_setup(self.maxmin)
 
         # actual_nb_keypoints is the number of keypoints returned by "local_maxmin".
         #After the interpolation, it will be reduced, but we can still use it as a boundary.
         shape = calc_size(keypoints_prev.shape, self.wg)
-        gpu_dogs = pyopencl.array.to_device(queue, DOGS)
-        gpu_keypoints1 = pyopencl.array.to_device(queue, keypoints_prev)
+        gpu_keypoints1 = self.gpu_keypoints
+        gpu_keypoints1.set(keypoints_prev, queue)
         #actual_nb_keypoints = numpy.int32(len((keypoints_prev[:,0])[keypoints_prev[:,1] != -1]))
         start_keypoints = numpy.int32(0)
         actual_nb_keypoints = numpy.int32(actual_nb_keypoints)
         InitSigma = numpy.float32(1.6) #warning: it must be the same in my_keypoints_interpolation
         t0 = time.time()
         k1 = self.program.interp_keypoint(queue, shape, self.wg,
-        	gpu_dogs.data, gpu_keypoints1.data, start_keypoints, actual_nb_keypoints,
+        	self.gpu_dogs.data, gpu_keypoints1.data, start_keypoints, actual_nb_keypoints,
         	peakthresh, InitSigma, width, height)
-        res = gpu_keypoints1.get()
-
+        queue.flush() #submit the kernel to the device now, not at the next blocking call
         t1 = time.time()
-        ref = numpy.copy(keypoints_prev) #important here
-        for i, k in enumerate(ref[:nb_keypoints, :]):
-            ref[i] = my_interp_keypoint(DOGS, s, k[1], k[2], 5, peakthresh, width, height)
-
+        #the reference is computed while the kernel runs
+        ref = my_interp_keypoints(DOGS, s, keypoints_prev[:nb_keypoints], 5, peakthresh, width, height) #new vector, keypoints_prev is untouched
         t2 = time.time()
 
+        res = gpu_keypoints1.get()
+        t3 = time.time()
+
 
         #we have to compare keypoints different from (-1,-1,-1,-1)
         res2 = res[res[:, 1] != -1]
@@ -253,7 +332,7 @@ class test_image(unittest.TestCase):
         logger.info("delta=%s" % delta)
 
         if PROFILE:
-            logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+            logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0 + t3 - t2)))
             logger.info("Keypoints interpolation took %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start)))
 
 
@@ -266,6 +345,7 @@ def test_suite_image():
     testSuite = unittest.TestSuite()
     testSuite.addTest(test_image("test_gradient"))
     testSuite.addTest(test_image("test_local_maxmin"))
+    testSuite.addTest(test_image("test_local_maxmin_batch"))
     testSuite.addTest(test_image("test_interpolation"))
     return testSuite
 
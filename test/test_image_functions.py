@@ -1,5 +1,27 @@
 #!/usr/bin/env python
+import os, multiprocessing
 import numpy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+def jit(func):
+    """
+    Compile the scalar reference functions with numba when it is available
+    """
+    if njit is None:
+        return func
+    return njit(cache=True)(func)
+
+#Without numba, the scalar reference can be run on several processes: export SIFT_REF_MP=1
+USE_MP = os.environ.get("SIFT_REF_MP", "0") == "1"
+
 def normalize_image(img):
     maxi = numpy.float32(img.max())
     mini = numpy.float32(img.min())
@@ -16,9 +38,25 @@ def my_gradient(mat):
     "The gradient is computed using central differences in the interior and first differences at the boundaries. The returned gradient hence has the same shape as the input array."
     NOTE:
         -with numpy.gradient, the amplitude is twice smaller than in SIFT.cpp, therefore we multiply the amplitude by two
+        -the differences of numpy.gradient are written directly on slices, norm and orientation
+        are then evaluated in a single pass by numexpr when it is available
     """
-    g = numpy.gradient(mat)
-    return 2.0*numpy.sqrt(g[0]**2+g[1]**2), numpy.arctan2(g[0],g[1]) #sift.cpp puts a "-" here
+    gy = numpy.empty_like(mat)
+    gx = numpy.empty_like(mat)
+    gy[1:-1] = (mat[2:] - mat[:-2]) * 0.5
+    gy[0] = mat[1] - mat[0]
+    gy[-1] = mat[-1] - mat[-2]
+    gx[:, 1:-1] = (mat[:, 2:] - mat[:, :-2]) * 0.5
+    gx[:, 0] = mat[:, 1] - mat[:, 0]
+    gx[:, -1] = mat[:, -1] - mat[:, -2]
+    if numexpr is not None:
+        norm = numexpr.evaluate("sqrt(gy*gy+gx*gx)")
+        ori = numexpr.evaluate("arctan2(gy,gx)") #sift.cpp puts a "-" here
+    else:
+        norm = numpy.hypot(gy,gx)
+        ori = numpy.arctan2(gy,gx) #sift.cpp puts a "-" here
+    norm *= 2.0
+    return norm, ori
     
     
     
@@ -30,6 +68,57 @@ def my_local_maxmin(DOGS,thresh,border_dist,octsize,EdgeThresh0,EdgeThresh,nb_ke
     a python implementation of 3x3 maximum (positive values) or minimum (negative or null values) detection
     an extremum candidate "val" has to be greater than 0.8*thresh
     The three DoG have the same size.
+    Vectorized version of the loop over all pixels calling is_maxmin: the 27 neighbours are compared
+    on shifted slices and keypoints are listed in the same order (column by column).
+    """
+    output = -numpy.ones((nb_keypoints,4),dtype=numpy.float32) #for invalid keypoints
+    
+    dog_prev = DOGS[s-1]
+    dog = DOGS[s]
+    dog_next = DOGS[s+1]
+    b = border_dist
+    h = dog_height
+    w = dog_width
+    
+    val = dog[b:h-b, b:w-b]
+    ismax = val > 0.0
+    ismin = numpy.logical_not(ismax)
+    for mat in (dog_prev, dog, dog_next):
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                neighbour = mat[b+di:h-b+di, b+dj:w-b+dj]
+                ismax &= (neighbour <= val)
+                ismin &= (neighbour >= val)
+    
+    #keypoint refinement: eliminating points at edges (same calculation as is_maxmin, in double precision)
+    val64 = val.astype(numpy.float64)
+    H00 = dog[b-1:h-b-1, b:w-b] - 2.0 * val64 + dog[b+1:h-b+1, b:w-b]
+    H11 = dog[b:h-b, b-1:w-b-1] - 2.0 * val64 + dog[b:h-b, b+1:w-b+1]
+    H01 = ( (dog[b+1:h-b+1, b+1:w-b+1] - dog[b+1:h-b+1, b-1:w-b-1])
+        - (dog[b-1:h-b-1, b+1:w-b+1] - dog[b-1:h-b-1, b-1:w-b-1]) ).astype(numpy.float64) / 4.0
+    det = H00 * H11 - H01 * H01
+    trace = H00 + H11
+    if (octsize <= 1):
+        thr = EdgeThresh0
+    else:
+        thr = EdgeThresh
+    
+    mask = (ismax | ismin) & numpy.logical_not(det < thr * trace * trace) & (numpy.abs(val64) > 0.8*thresh)
+    # transpose to keep the order of the original loop: j (columns) outside, i (rows) inside
+    jj, ii = numpy.nonzero(mask.T)
+    counter = jj.size
+    output[:counter,0] = val[ii, jj]
+    output[:counter,1] = ii + b
+    output[:counter,2] = jj + b
+    output[:counter,3] = numpy.float32(s)
+    return output, counter
+    
+    
+@jit
+def my_local_maxmin_loop(DOGS,thresh,border_dist,octsize,EdgeThresh0,EdgeThresh,nb_keypoints,s,dog_width,dog_height):
+    """
+    Scalar version of my_local_maxmin (loop over all pixels calling is_maxmin),
+    compiled with numba if available.
     """
     output = -numpy.ones((nb_keypoints,4),dtype=numpy.float32) #for invalid keypoints
     
@@ -41,22 +130,64 @@ def my_local_maxmin(DOGS,thresh,border_dist,octsize,EdgeThresh0,EdgeThresh,nb_ke
     for j in range(border_dist,dog_width - border_dist):
         for i in range(border_dist,dog_height - border_dist):
             val = dog[i,j]
-            if (numpy.abs(val) > 0.8*thresh): #keypoints refinement: eliminating low-contrast points
+            if (abs(val) > 0.8*thresh): #keypoints refinement: eliminating low-contrast points
                 if (is_maxmin(dog_prev,dog,dog_next,val,i,j,octsize,EdgeThresh0,EdgeThresh) != 0):
                     output[counter,0]=val
                     output[counter,1]=i
                     output[counter,2]=j
-                    output[counter,3]=numpy.float32(s)
+                    output[counter,3]=s
                     counter+=1              
     return output, counter
+
+
+def _local_maxmin_columns(args):
+    """
+    Worker of my_local_maxmin_parallel: keypoints (val, i, j, s) found in the columns j_start <= j < j_end
+    """
+    dogs, thresh, border_dist, octsize, EdgeThresh0, EdgeThresh, s, dog_height, j_start, j_end = args
+    dog_prev, dog, dog_next = dogs
+    found = []
+    for j in range(j_start, j_end):
+        for i in range(border_dist,dog_height - border_dist):
+            val = dog[i,j]
+            if (abs(val) > 0.8*thresh): #keypoints refinement: eliminating low-contrast points
+                if (is_maxmin(dog_prev,dog,dog_next,val,i,j,octsize,EdgeThresh0,EdgeThresh) != 0):
+                    found.append((val, i, j, s))
+    return found
+
+
+def my_local_maxmin_parallel(DOGS,thresh,border_dist,octsize,EdgeThresh0,EdgeThresh,nb_keypoints,s,dog_width,dog_height,nproc=None):
+    """
+    Scalar version of my_local_maxmin, the columns being split between nproc processes.
+    Keypoints are listed in the same order as my_local_maxmin_loop.
+    """
+    nproc = nproc or multiprocessing.cpu_count()
+    bounds = numpy.linspace(border_dist, dog_width - border_dist, nproc + 1).astype(numpy.int32)
+    dogs = DOGS[s-1:s+2] #only the 3 DoGs used are sent to the workers
+    chunks = [(dogs, thresh, border_dist, octsize, EdgeThresh0, EdgeThresh, s, dog_height, bounds[k], bounds[k+1])
+              for k in range(nproc)]
+    pool = multiprocessing.Pool(nproc)
+    try:
+        results = pool.map(_local_maxmin_columns, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    found = [k for chunk in results for k in chunk][:nb_keypoints]
+    counter = len(found)
+    output = -numpy.ones((nb_keypoints,4),dtype=numpy.float32) #for invalid keypoints
+    if counter:
+        output[:counter] = found
+    return output, counter
     
     
+@jit
 def is_maxmin(dog_prev,dog,dog_next,val,i0,j0,octsize,EdgeThresh0,EdgeThresh):
     """
     return 1 iff mat[i0,j0] is a local (3x3) maximum
     return -1 iff mat[i0,j0] is a local (3x3) minimum
     return 0 by default (neither maximum nor minimum, or value on an edge)
      * Assumes that we are not on the edges, i.e border_dist >= 2 above
+     * Returns as soon as a neighbour rules out the extremum: the edge test is only done for extrema
     """
     ismax = 0
     ismin = 0
@@ -69,6 +200,7 @@ def is_maxmin(dog_prev,dog,dog_next,val,i0,j0,octsize,EdgeThresh0,EdgeThresh):
                 if (dog_prev[i,j] > val or dog[i,j] > val or dog_next[i,j] > val): ismax = 0
             if (ismin == 1):
                 if (dog_prev[i,j] < val or dog[i,j] < val or dog_next[i,j] < val): ismin = 0
+            if (ismax == 0 and ismin == 0): return 0
     
     if (ismax == 1): res =  1 
     if (ismin == 1): res = -1
@@ -105,7 +237,8 @@ def my_interp_keypoint(DOGS, s, r, c,movesRemain,peakthresh,width,height):
      A Python implementation of SIFT "InterpKeyPoints"
      (s,r,c) : coords of the processed keypoint in the scale space
      WARNING: replace "1.6" by "InitSigma" if InitSigma has not its default value 
-     The recursive calls were replaced by a loop.
+     The recursive calls were replaced by a loop, stopping when the keypoint is at its initial
+     position (r,c) or after movesRemain moves (same test as kernel interp_keypoint).
     '''
     if (r == -1): return (-1,-1,-1,-1)
     dog_prev = DOGS[s-1]
@@ -113,10 +246,7 @@ def my_interp_keypoint(DOGS, s, r, c,movesRemain,peakthresh,width,height):
     dog_next = DOGS[s+1]
     newr = r
     newc = c
-    loop = 1
-    movesRemain = 5
-    while (loop == 1):
-        
+    while True:
         r0, c0 = newr, newc
         x,peakval = fit_quadratic(dog_prev,dog,dog_next, newr, newc)
         
@@ -133,48 +263,99 @@ def my_interp_keypoint(DOGS, s, r, c,movesRemain,peakthresh,width,height):
         if (movesRemain > 0  and  (newr != r or newc != c)):
             movesRemain-=1
         else:
-            loop = 0
-            
+            break
 
     if (abs(x[0]) <  1.5 and abs(x[1]) <  1.5 and abs(x[2]) <  1.5 and abs(peakval) > peakthresh):
-        ki = numpy.zeros(4,dtype=numpy.float32)
-        ki[0] = peakval
-        ki[1] = r0 + x[1]
-        ki[2] = c0 + x[2]
-        ki[3] = 1.6 * 2.0**((float(s) + x[0]) / 3.0) #3.0 is "par.Scales" 
+        ki = (peakval, r0 + x[1], c0 + x[2], 1.6 * 2.0**((float(s) + x[0]) / 3.0)) #3.0 is "par.Scales" 
     else:
         ki = (-1,-1,-1,-1)
     
     return ki #our interpolated keypoint
 
 
+def my_interp_keypoints(DOGS, s, keypoints, movesRemain, peakthresh, width, height):
+    '''
+    Vectorized version of my_interp_keypoint, processing all the keypoints of a vector at once.
+    At each move, "fit_quadratic" is called on the coordinates of the keypoints still moving;
+    the stopping test is the same as in my_interp_keypoint.
+    Keypoints (-1,-1,-1,-1) are left untouched.
+    '''
+    res = -numpy.ones((keypoints.shape[0], 4), dtype=numpy.float32)
+    valid = numpy.nonzero(keypoints[:, 1] != -1)[0]
+    if valid.size == 0: return res
+    dog_prev = DOGS[s-1]
+    dog = DOGS[s]
+    dog_next = DOGS[s+1]
+    r = keypoints[valid, 1].astype(numpy.int32)
+    c = keypoints[valid, 2].astype(numpy.int32)
+    newr = r.copy()
+    newc = c.copy()
+    r0 = r.copy()
+    c0 = c.copy()
+    x = numpy.zeros((3, valid.size), dtype=numpy.float32)
+    peakval = numpy.zeros(valid.size, dtype=numpy.float32)
+    moves = numpy.zeros(valid.size, dtype=numpy.int32) + movesRemain
+    active = numpy.arange(valid.size)
+    while active.size:
+        ra, ca = newr[active], newc[active]
+        r0[active], c0[active] = ra, ca
+        xa, pa = fit_quadratic(dog_prev, dog, dog_next, ra, ca)
+        x[:, active] = xa
+        peakval[active] = pa
+
+        ra = ra + ((xa[1] > 0.6) & (ra < height - 3)) - ((xa[1] < -0.6) & (ra > 3))
+        ca = ca + ((xa[2] > 0.6) & (ca < width - 3)) - ((xa[2] < -0.6) & (ca > 3))
+        newr[active], newc[active] = ra, ca
+
+        #loop test
+        moving = (moves[active] > 0) & ((ra != r[active]) | (ca != c[active]))
+        active = active[moving]
+        moves[active] -= 1
+
+    ok = (abs(x) < 1.5).all(axis=0) & (abs(peakval) > peakthresh)
+    kept = valid[ok]
+    res[kept, 0] = peakval[ok]
+    res[kept, 1] = r0[ok] + x[1, ok]
+    res[kept, 2] = c0[ok] + x[2, ok]
+    res[kept, 3] = 1.6 * 2.0 ** ((float(s) + x[0, ok]) / 3.0) #3.0 is "par.Scales"
+    return res
+
+
 def fit_quadratic(dog_prev,dog,dog_next, r, c):
     '''
     quadratic interpolation arround the keypoint (s,r,c)
+    The 3x3 symmetric system H.x = -g is solved with Cramer's rule (adjugate of H)
+    r and c can also be arrays of coordinates: x is then of shape (3, len(r))
     '''
 
     #gradient
-    g = numpy.zeros(3,dtype=numpy.float32)
-    g[0] = (dog_next[r,c] - dog_prev[r,c]) / 2.0
-    g[1] = (dog[r+1,c] - dog[r-1,c]) / 2.0
-    g[2] = (dog[r,c+1] - dog[r,c-1]) / 2.0
+    g0 = numpy.float32((dog_next[r,c] - dog_prev[r,c]) / 2.0)
+    g1 = numpy.float32((dog[r+1,c] - dog[r-1,c]) / 2.0)
+    g2 = numpy.float32((dog[r,c+1] - dog[r,c-1]) / 2.0)
     #hessian
-    H = numpy.zeros((3,3)).astype(numpy.float32)
-    H[0][0] = dog_prev[r,c]   - 2.0 * dog[r,c] + dog_next[r,c]
-    H[1][1] = dog[r-1,c] - 2.0 * dog[r,c] + dog[r+1,c]
-    H[2][2] = dog[r,c-1] - 2.0 * dog[r,c] + dog[r,c+1]
-    H[0][1] = H[1][0] = ( (dog_next[r+1,c] - dog_next[r-1,c])
-                         - (dog_prev[r+1,c] - dog_prev[r-1,c]) ) / 4.0
-
-
-    H[0][2] = H[2][0] = ( (dog_next[r,c+1] - dog_next[r,c-1])
-                     - (dog_prev[r,c+1] - dog_prev[r,c-1]) ) / 4.0
-
-    H[1][2] = H[2][1]= ( (dog[r+1,c+1] - dog[r+1,c-1])
-                     - (dog[r-1,c+1] - dog[r-1,c-1]) ) / 4.0
-             
-    x = -numpy.dot(numpy.linalg.inv(H),g) #extremum position
-    peakval = dog[r,c] + 0.5 * (x[0]*g[0]+x[1]*g[1]+x[2]*g[2])
+    H00 = numpy.float32(dog_prev[r,c]   - 2.0 * dog[r,c] + dog_next[r,c])
+    H11 = numpy.float32(dog[r-1,c] - 2.0 * dog[r,c] + dog[r+1,c])
+    H22 = numpy.float32(dog[r,c-1] - 2.0 * dog[r,c] + dog[r,c+1])
+    H01 = numpy.float32(( (dog_next[r+1,c] - dog_next[r-1,c])
+                         - (dog_prev[r+1,c] - dog_prev[r-1,c]) ) / 4.0)
+    H02 = numpy.float32(( (dog_next[r,c+1] - dog_next[r,c-1])
+                     - (dog_prev[r,c+1] - dog_prev[r,c-1]) ) / 4.0)
+    H12 = numpy.float32(( (dog[r+1,c+1] - dog[r+1,c-1])
+                     - (dog[r-1,c+1] - dog[r-1,c-1]) ) / 4.0)
+
+    #adjugate (symmetric) and determinant
+    A00 = H11 * H22 - H12 * H12
+    A01 = H02 * H12 - H01 * H22
+    A02 = H01 * H12 - H02 * H11
+    A11 = H00 * H22 - H02 * H02
+    A12 = H01 * H02 - H00 * H12
+    A22 = H00 * H11 - H01 * H01
+    det = H00 * A00 + H01 * A01 + H02 * A02
+
+    x = numpy.array([-(A00 * g0 + A01 * g1 + A02 * g2) / det,
+                     -(A01 * g0 + A11 * g1 + A12 * g2) / det,
+                     -(A02 * g0 + A12 * g1 + A22 * g2) / det], dtype=numpy.float32) #extremum position
+    peakval = dog[r,c] + 0.5 * (x[0]*g0+x[1]*g1+x[2]*g2)
     
     return x, peakval
     
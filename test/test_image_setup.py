@@ -31,20 +31,21 @@ def local_maxmin_setup():
     nb_keypoints = 1000 #constant size !
     doubleimsize = 0 #par.DoubleImSize = 0 by default
 
-    l2 = scipy.misc.lena().astype(numpy.float32)#[100:250,100:250] #use a part of the image to fasten tests
-    l2 = numpy.ascontiguousarray(l2[0:507, 0:209]);
+    #use a part of the image to fasten tests: only this part is converted to float32
+    l2 = numpy.ascontiguousarray(scipy.misc.lena()[0:507, 0:209], dtype=numpy.float32)
     #l2 = scipy.misc.imread("../aerial.tiff").astype(numpy.float32)
     l = normalize_image(l2) #do not forget to normalize the image if you want to compare with sift.cpp
-    for octave_cnt in range(1, int(numpy.log2(octsize)) + 1 + 1):
+    last_octave = int(numpy.log2(octsize)) + 1
+    for octave_cnt in range(1, last_octave + 1):
 
 
         width = numpy.int32(l.shape[1])
         height = numpy.int32(l.shape[0])
 
         #Blurs and DoGs pre-allocating
-        g = (numpy.zeros(6 * height * width).astype(numpy.float32)).reshape(6, height, width) #vector of 6 blurs
-        DOGS = numpy.zeros((5, height, width), dtype=numpy.float32) #vector of 5 DoGs
-        g[0, :, :] = numpy.copy(l)
+        g = numpy.empty((6, height, width), dtype=numpy.float32) #vector of 6 blurs
+        DOGS = numpy.empty((5, height, width), dtype=numpy.float32) #vector of 5 DoGs
+        g[0, :, :] = l
         '''
         sift.cpp pre-process
         '''
@@ -57,20 +58,23 @@ def local_maxmin_setup():
                 sigma = numpy.sqrt(initsigma ** 2 - cursigma ** 2)
                 g[0, :, :] = my_blur(l, sigma)
         else:
-            g[0, :, :] = numpy.copy(l)
+            g[0, :, :] = l
         '''
         Blurs and DoGs
         '''
         sigmaratio = 2 ** (1 / 3.0) #sift.cpp
         #sift.cpp : for a given "i", we have : increase = initsigma*(sigmaratio)^(i-1)*sqrt(sigmaratio**2 -1)
-        for i in range(1, 6):
+        #i.e. blur[i] is obtained from blur[i-1] with sqrt(sigma_i**2 - sigma_(i-1)**2), never from the image
+        #Lower octaves are only needed to get Blur[3], which is sampled for the next octave
+        nb_blurs = 6 if (octave_cnt == last_octave) else 4
+        for i in range(1, nb_blurs):
             sigma = initsigma * (sigmaratio) ** (i - 1.0) * numpy.sqrt(sigmaratio ** 2 - 1.0) #sift.cpp "increase"
             g[i] = my_blur(g[i - 1], sigma) #blur[i]
 
-        for s in range(1, 6): DOGS[s - 1] = -(g[s] - g[s - 1]) #DoG[s-1]
-
-        if (octsize > 1): #if a higher octave is required, we have to sample Blur[3]
+        if (octave_cnt < last_octave): #if a higher octave is required, we have to sample Blur[3]
             l = shrink(g[3], 2, 2)
+        else:
+            for s in range(1, 6): DOGS[s - 1] = -(g[s] - g[s - 1]) #DoG[s-1]
     #end for
 
     #print("[Octave %s] printing blur 2" %(int(numpy.log2(octsize))+1))
@@ -83,13 +87,15 @@ def local_maxmin_setup():
 
 
 
-def interpolation_setup():
+def interpolation_setup(maxmin=None):
     '''
     Provides the values required by "test_interpolation"
     Previous step: local extrema detection - we got a vector of keypoints to be interpolated
+    :param maxmin: result of a previous call to local_maxmin_setup, to avoid building the pyramid again
     '''
-
-    border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = local_maxmin_setup()
+    if maxmin is None:
+        maxmin = local_maxmin_setup()
+    border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, s, nb_keypoints, width, height, DOGS, g = maxmin
 
     nb_keypoints = numpy.int32(nb_keypoints)
 
@@ -110,10 +116,8 @@ def orientation_setup():
     border_dist, peakthresh, EdgeThresh, EdgeThresh0, octsize, nb_keypoints, actual_nb_keypoints, width, height, DOGS, s, keypoints_prev, blur = interpolation_setup()
 
     #actual_nb_keypoints = numpy.int32(len((keypoints_prev[:,0])[keypoints_prev[:,1] != -1]))
-    ref = numpy.copy(keypoints_prev)
-    #There are actually less than "actual_nb_keypoints" keypoints ("holes" in the vector), but we can use it as a boundary
-    for i, k in enumerate(ref[:actual_nb_keypoints, :]):
-        ref[i] = my_interp_keypoint(DOGS, s, k[1], k[2], 5, peakthresh, width, height)
+    #my_interp_keypoints returns a new vector, and leaves (-1,-1,-1,-1) after "actual_nb_keypoints" as they are
+    ref = my_interp_keypoints(DOGS, s, keypoints_prev, 5, peakthresh, width, height)
 
     grad, ori = my_gradient(blur) #gradient is applied on blur[s]
    # ref, actual_nb_keypoints = my_compact(ref,nb_keypoints)
@@ -145,7 +149,7 @@ def matching_setup():
     Previous step: descriptors - we got a vector of 128-values descriptors
     '''
     keypoints, nb_keypoints, actual_nb_keypoints, grad, ori, octsize = descriptor_setup()
-    keypoints, actual_nb_keypoints = my_compact(numpy.copy(keypoints), nb_keypoints)
+    keypoints, actual_nb_keypoints = my_compact(keypoints, nb_keypoints)
     keypoints_start, keypoints_end = 0, actual_nb_keypoints
     desc = my_descriptor(keypoints, grad, ori, octsize, keypoints_start, keypoints_end)
     #keypoints with their descriptors
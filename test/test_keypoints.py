@@ -141,7 +141,7 @@ class test_keypoints(ParameterisedTestCase):
             return
         #orientation_setup :
         keypoints, nb_keypoints, updated_nb_keypoints, grad, ori, octsize = orientation_setup()
-        keypoints, compact_cnt = my_compact(numpy.copy(keypoints),nb_keypoints)
+        keypoints, compact_cnt = my_compact(keypoints,nb_keypoints)
         updated_nb_keypoints = compact_cnt
         
 #        if (USE_CPU):
@@ -227,7 +227,7 @@ class test_keypoints(ParameterisedTestCase):
         #descriptor_setup :
         keypoints_o, nb_keypoints, actual_nb_keypoints, grad, ori, octsize = descriptor_setup()
         #keypoints should be a compacted vector of keypoints
-        keypoints_o, compact_cnt = my_compact(numpy.copy(keypoints_o),nb_keypoints)
+        keypoints_o, compact_cnt = my_compact(keypoints_o,nb_keypoints)
         actual_nb_keypoints = compact_cnt
         keypoints_start, keypoints_end = 0, actual_nb_keypoints
         keypoints = keypoints_o[keypoints_start:keypoints_end+52] #to check if we actually stop at keypoints_end
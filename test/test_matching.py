@@ -46,7 +46,7 @@ import pyopencl, pyopencl.array
 import scipy, scipy.misc, scipy.ndimage, pylab
 import sys
 import unittest
-from utilstest import UtilsTest, getLogger, ctx
+from utilstest import UtilsTest, getLogger, ctx, build_program
 from test_image_functions import * #for Python implementation of tested functions
 from test_image_setup import *
 import sift_pyocl as sift
@@ -80,8 +80,7 @@ class test_matching(unittest.TestCase):
         
         kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), ("matching_gpu.cl" if not(USE_CPU) else "matching_cpu.cl"))
         print kernel_path
-        kernel_src = open(kernel_path).read()
-        self.program = pyopencl.Program(ctx, kernel_src).build() #.build('-D WORKGROUP_SIZE=%s' % wg_size)
+        self.program = build_program(kernel_path) #.build('-D WORKGROUP_SIZE=%s' % wg_size)
         self.wg = (1, 128)
 
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: Sift implementation in Python + OpenCL
+#             https://github.com/kif/sift_pyocl
+#
+
+"""
+Test suite for the SiftPlan class (fallbacks, buffers management)
+"""
+
+from __future__ import division
+
+__authors__ = ["Jérôme Kieffer"]
+__contact__ = "jerome.kieffer@esrf.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "2016-11-03"
+__license__ = """
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+
+import time, os, logging
+import numpy
+import pyopencl, pyopencl.array
+import scipy, scipy.misc, scipy.ndimage
+import sys
+import unittest
+from utilstest import UtilsTest, getLogger, ctx
+import sift_pyocl as sift
+import sift_pyocl.plan
+logger = getLogger(__file__)
+if logger.getEffectiveLevel() <= logging.INFO:
+    PROFILE = True
+else:
+    PROFILE = False
+
+print "working on %s" % ctx.devices[0].name
+
+
+def my_blur(img, kernel):
+    """
+    hand made implementation of gaussian blur with OUR kernel
+    which differs from Scipy's if ksize is even
+    """
+    tmp1 = scipy.ndimage.filters.convolve1d(img, kernel, axis= -1, mode="reflect")
+    return scipy.ndimage.filters.convolve1d(tmp1, kernel, axis=0, mode="reflect")
+
+
+class test_plan(unittest.TestCase):
+    def setUp(self):
+        self.input = scipy.misc.lena().astype(numpy.float32)
+        self.input = numpy.ascontiguousarray(self.input[0:507, 0:209])
+        self.plan = sift.SiftPlan(template=self.input, context=ctx, profile=PROFILE)
+
+    def tearDown(self):
+        self.input = None
+        self.plan = None
+
+    def test_convolution_fallback(self):
+        """
+        tests the gaussian blur when the program specialized for the filter size does not compile
+        """
+        plan = self.plan
+        sigma, ksize = plan.blurs[0]
+        gaussian = plan.buffers["gaussian_%s" % sigma].get()
+        plan.buffers[1].set(self.input)
+        plan._gaussian_convolution(plan.buffers[1], plan.buffers[2], sigma)
+        res_ksize = plan.buffers[2].get()
+
+        #Force the failure of the specialized build
+        get_opencl_code = sift_pyocl.plan.get_opencl_code
+        def broken_code(name):
+            src = get_opencl_code(name)
+            if name == "convolution":
+                src += "\n#error compilation failure forced by test_convolution_fallback\n"
+            return src
+        plan.programs.pop("convolution_%i" % ksize)
+        plan.conv_kernels.pop(ksize)
+        plan.conv_workgroups.pop(ksize)
+        sift_pyocl.plan.get_opencl_code = broken_code
+        try:
+            program = plan._compile_convolution(ksize)
+        finally:
+            sift_pyocl.plan.get_opencl_code = get_opencl_code
+        self.assert_(program is plan.programs["convolution"], "generic program used as fallback")
+
+        plan.buffers[2].fill(numpy.float32(0))
+        plan._gaussian_convolution(plan.buffers[1], plan.buffers[2], sigma)
+        res = plan.buffers[2].get()
+        ref = my_blur(self.input, gaussian)
+        delta = abs(res - res_ksize).max()
+        delta_ref = abs(res - ref).max()
+        logger.info("sigma=%s ksize=%s delta specialized=%s delta ref=%s" % (sigma, ksize, delta, delta_ref))
+        self.assert_(delta < 1e-4, "fallback and specialized kernels differ: delta=%s" % delta)
+        self.assert_(delta_ref < 1e-4, "delta_ref=%s" % delta_ref)
+
+    def test_buffer_pool(self):
+        """
+        tests that a second plan of the same shape reuses the device buffers of the first one
+        """
+        sift_pyocl.plan.clear_buffer_pool()
+        plan1 = sift.SiftPlan(template=self.input, context=ctx, pool_buffers=True)
+        #buffers of the same shape and dtype are interchangeable: compare the sets of pointers
+        pointers1 = set(plan1.buffers[name].data.int_ptr for name in plan1._pooled)
+        self.assert_(len(pointers1) > 0, "plan1 uses the pool")
+        plan1._free_buffers()
+        self.assert_(sift_pyocl.plan.buffer_pool_size() > 0, "buffers returned to the pool")
+        plan2 = sift.SiftPlan(template=self.input, context=ctx, pool_buffers=True)
+        pointers2 = set(plan2.buffers[name].data.int_ptr for name in plan2._pooled)
+        self.assert_(pointers1 == pointers2, "plan2 reuses all buffers of plan1")
+        self.assert_(sift_pyocl.plan.buffer_pool_size() == 0, "all pooled buffers are in use")
+        plan2._free_buffers()
+        sift_pyocl.plan.clear_buffer_pool()
+        self.assert_(sift_pyocl.plan.buffer_pool_size() == 0, "pool is empty")
+        self.assert_(len(sift_pyocl.plan._BUFFER_POOL) == 0, "no buffer left in the pool")
+
+        #without pool_buffers, nothing is kept
+        plan3 = sift.SiftPlan(template=self.input, context=ctx)
+        plan3._free_buffers()
+        self.assert_(sift_pyocl.plan.buffer_pool_size() == 0, "pooling is opt-in")
+
+
+def test_suite_plan():
+    testSuite = unittest.TestSuite()
+    testSuite.addTest(test_plan("test_convolution_fallback"))
+    testSuite.addTest(test_plan("test_buffer_pool"))
+    return testSuite
+
+if __name__ == '__main__':
+    mysuite = test_suite_plan()
+    runner = unittest.TextTestRunner()
+    if not runner.run(mysuite).wasSuccessful():
+        sys.exit(1)
@@ -46,7 +46,7 @@ import pyopencl, pyopencl.array
 import scipy, scipy.misc
 import sys
 import unittest
-from utilstest import UtilsTest, getLogger, ctx
+from utilstest import UtilsTest, getLogger, ctx, build_program
 import sift_pyocl as sift
 from sift_pyocl.utils import calc_size
 import math
@@ -123,10 +123,8 @@ class test_preproc(unittest.TestCase):
         self.gpudata = pyopencl.array.empty(queue, self.input.shape, dtype=numpy.float32, order="C")
         kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "preprocess.cl")
         reduct_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "reductions.cl")
-        kernel_src = open(kernel_path).read()
-        reduct_src = open(reduct_path).read()
-        self.program = pyopencl.Program(ctx, kernel_src).build()
-        self.reduction = pyopencl.Program(ctx, reduct_src).build()
+        self.program = build_program(kernel_path)
+        self.reduction = build_program(reduct_path)
         self.IMAGE_W = numpy.int32(self.input.shape[-1])
         self.IMAGE_H = numpy.int32(self.input.shape[0])
         self.wg = (32, 16)#(256, 2) #(32, 16) # (2, 256)
@@ -188,6 +186,43 @@ class test_preproc(unittest.TestCase):
 
         self.assert_(delta < 1e-4, "delta=%s" % delta)
 
+    def test_uint8_normalized(self):
+        """
+        tests the uint8 kernel fused with the normalization, min/max calculated on the raw data
+        """
+        lint = self.input.astype(numpy.uint8)
+        reduct_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "reductions.cl")
+        reduction = build_program(reduct_path, "-D DTYPE=uchar")
+        t0 = time.time()
+        au8 = pyopencl.array.to_device(queue, lint)
+        k1 = reduction.max_min_global_stage1(queue, (self.red_size * self.red_size,), (self.red_size,),
+                                                               au8.data,
+                                                               self.buffers_max_min.data,
+                                                               (self.IMAGE_W * self.IMAGE_H))
+        k2 = reduction.max_min_global_stage2(queue, (self.red_size,), (self.red_size,),
+                                                               self.buffers_max_min.data,
+                                                               self.buffers_max.data,
+                                                               self.buffers_min.data)
+        k3 = self.program.u8_to_float_normalized(queue, self.shape, self.wg,
+                                     au8.data,
+                                     self.gpudata.data,
+                                     self.buffers_min.data,
+                                     self.buffers_max.data,
+                                     self.twofivefive.data,
+                                     self.IMAGE_W, self.IMAGE_H)
+        res = self.gpudata.get()
+        t1 = time.time()
+        ref = normalize(lint)
+        t2 = time.time()
+        delta = abs(ref - res).max()
+        if PROFILE:
+            logger.info("Global execution time: CPU %.3fms, GPU: %.3fms." % (1000.0 * (t2 - t1), 1000.0 * (t1 - t0)))
+            logger.info("Reduction stage1 took        %.3fms" % (1e-6 * (k1.profile.end - k1.profile.start)))
+            logger.info("Reduction stage2 took        %.3fms" % (1e-6 * (k2.profile.end - k2.profile.start)))
+            logger.info("Conversion + normalization   %.3fms" % (1e-6 * (k3.profile.end - k3.profile.start)))
+            logger.info("--------------------------------------")
+        self.assert_(delta < 1e-4, "delta=%s" % delta)
+
     def test_uint16(self):
         """
         tests the uint16 kernel
@@ -426,6 +461,7 @@ class test_preproc(unittest.TestCase):
 def test_suite_preproc():
     testSuite = unittest.TestSuite()
     testSuite.addTest(test_preproc("test_uint8"))
+    testSuite.addTest(test_preproc("test_uint8_normalized"))
     testSuite.addTest(test_preproc("test_uint16"))
     testSuite.addTest(test_preproc("test_int32"))
     testSuite.addTest(test_preproc("test_int64"))
@@ -46,9 +46,9 @@ import pyopencl, pyopencl.array
 import scipy, scipy.misc
 import sys
 import unittest
-from utilstest import UtilsTest, getLogger, ctx
+from utilstest import UtilsTest, getLogger, ctx, build_program
 import sift_pyocl as sift
-from sift_pyocl.utils import calc_size
+from sift_pyocl.utils import calc_size, nextpower
 
 logger = getLogger(__file__)
 
@@ -66,8 +66,7 @@ else:
 class test_reductions(unittest.TestCase):
     def setUp(self):
         kernel_path = os.path.join(os.path.dirname(os.path.abspath(sift.__file__)), "reductions.cl")
-        kernel_src = open(kernel_path).read()
-        self.program = pyopencl.Program(ctx, kernel_src).build(options="")
+        self.program = build_program(kernel_path)
 
     def tearDown(self):
         self.program = None
@@ -90,7 +89,7 @@ class test_reductions(unittest.TestCase):
             #        data = numpy.zeros(shape, dtype=numpy.float32)
         inp_gpu = pyopencl.array.to_device(queue, data)
         wg_float = min(512.0, numpy.sqrt(data.size))
-        wg = 2 ** (int(math.ceil(math.log(wg_float, 2))))
+        wg = nextpower(wg_float)
         size = wg * wg
         max_min_gpu = pyopencl.array.zeros(queue, (wg, 2), dtype=numpy.float32, order="C")
 #        max_min_gpu = pyopencl.array.empty(queue, (wg, 2), dtype=numpy.float32, order="C")
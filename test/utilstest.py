@@ -288,4 +288,25 @@ else:
     ctx = ocl.create_context(devicetype=options.device)
 print("working on %s" % ctx.devices[0].name)
 
+import pyopencl
+#Programs built on the shared context, by (kernel file, modification time, options)
+_PROGRAM_CACHE = {}
+
+def build_program(kernel_path, options=""):
+    """
+    Build the OpenCL program of a kernel file on the shared context.
+    Compilation happens only once for all tests, unless the file is modified.
+
+    :param kernel_path: path of the .cl file
+    :param options: compilation options
+    :return: built pyopencl program
+    """
+    key = (os.path.abspath(kernel_path), os.path.getmtime(kernel_path), options)
+    if key not in _PROGRAM_CACHE:
+        with open(kernel_path) as f:
+            kernel_src = f.read()
+        _PROGRAM_CACHE[key] = pyopencl.Program(ctx, kernel_src).build(options)
+    return _PROGRAM_CACHE[key]
+
+
 